@@ -2,15 +2,17 @@
 import configparser
 import toml
 import streamlit as st
-import tkinter as tk
-from tkinter import filedialog
-import glob
-from modules.calibration import load_data
+from modules.spectra import spectrum_store
+from modules.calibration import AUTOMATIC
+from modules.index import get_index
+from modules.peaks import peak_table
+from modules.export import FORMATS, export, unique_names
+from modules.accumulation import select_shots, compatible, accumulate, save_average
+from modules.rebinning import grid, centres, combine
+from modules.decimation import minmax
 import modules
+from modules import instrumentation
 import numpy as np
-import pandas as pd 
-import plotly.express as px
-import os.path
 
 # Page Config
 st.set_page_config(
@@ -18,6 +20,7 @@ st.set_page_config(
     page_icon="https://static-00.iconduck.com/assets.00/python-icon-512x509-pb65l7gl.png",
     layout='wide')
 st.write("# FCS Visualiser")
+instrumentation.begin_rerun('Visualiser')
 try:
     with open('defaults.toml', 'r') as f:
         defaults = toml.load(f)
@@ -39,20 +42,15 @@ if 'old_data' not in st.session_state:
     st.session_state['old_data'] = []
 if 'baseline' not in st.session_state:
     st.session_state['baseline'] = None
-if 'dataframe' not in st.session_state:
-    st.session_state['dataframe'] = pd.DataFrame({'time': [],
-                                                'mass': [],
-                                                'mass_element': [],
-                                                'voltage': [],
-                                                'norm': [],
-                                                'name': []})
+if 'store' not in st.session_state:
+    st.session_state['store'] = spectrum_store()
 if 'figure' not in st.session_state:
-    st.session_state['figure'] = px.line([])
-
-file_extension = "*.npy"
+    st.session_state['figure'] = None
 
 # Folder selection in sidebar
 def select_folder():
+    import tkinter as tk    # only when the dialog is opened (app startup)
+    from tkinter import filedialog
     root = tk.Tk()
     root.attributes('-topmost', True)
     root.withdraw()
@@ -71,61 +69,50 @@ with st.sidebar:
                 st.session_state['directory'] = selected
     ## Refresh Files
     with col2:
-        if st.button("Refresh Files"):
-            file_location = st.session_state['directory'] + "//*" + file_extension
-            all_files = glob.glob(file_location)
+        refresh = st.button("Refresh Files")
     ## Print/Edit Directory
     st.session_state['directory'] = st.text_input("Directory", value=st.session_state['directory'])
-    directory_length = len(st.session_state['directory'])
-    file_location = st.session_state['directory'] + "//*" + file_extension
-    all_files = glob.glob(file_location)    # Load files
+    index = get_index(st.session_state['directory'], force=refresh)    # Only rescans when the directory changed
     	
 
 # Data Selection
 # Define data structure
+@instrumentation.callback
 def gen_df(): 
     init_param = [st.session_state['a'], st.session_state['k']]
-    st.session_state['dataframe'] = pd.DataFrame({'time': [],
-                                                'mass': [],
-                                                'voltage': [],
-                                                'name': []})  
-    for name in st.session_state['data']:
-        directory = all_files[0][:directory_length+6] + name
-        try:
-            data = load_data(directory, init_param)
-            df = pd.DataFrame({'time': data.time,
-                        'mass': data.mass,
-                        'voltage': data.voltage,
-                        'name': [name]*len(data.time)})
-        except OSError:
-            return
-
-        if st.session_state['baseline'] is not None:
-            data.baseline_correction(lam, multiplier, st.session_state['baseline'])
-            df['baseline'] = data.baseline
-           
-        st.session_state['dataframe'] = pd.concat([st.session_state['dataframe'], df])
+    store = st.session_state['store']
+    files = {name: index.path(name) for name in st.session_state['data']}
+    try:
+        store.select(files, init_param)     # Only loads newly selected files
+    except OSError:
+        return
+    store.calibrate(*init_param)    # Only recomputes the mass axis
+    st.session_state['baseline_error'] = None
+    try:
+        store.baseline_correction(lam, multiplier, st.session_state['baseline'], persist)
+    except ValueError as error:     # baseline of another record length
+        st.session_state['baseline_error'] = str(error)
 
 # Save Data
+@instrumentation.callback
 def save():
-    for name in st.session_state['data']:
-        # Initialise filename
-        directory = all_files[0][:directory_length+6]
-        name = name[:-4] + '_adj'
-        clean_name = name
-        i = 0
-        ## Find unique file name
-        while os.path.isfile(directory + name + '.npy'):
-            name = clean_name + '_' + str(i)
-            i += 1
-
-        # Select data from dataframe
-        df = st.session_state['dataframe']
-        df = df[df['name'] == df['name']]
-        to_save = df[['time', 'voltage']]
-        to_save.loc[:, 'time'] *= 1e-6
-        to_save.loc[:, 'voltage'] = -to_save['voltage']
-        np.save(directory + name + '.npy', to_save.to_numpy())
+    # Each spectrum's own corrected record, or one bundle of all of them
+    export(st.session_state['store'], st.session_state['data'], index.directory, FORMATS[export_format])
+    index.refresh()
+
+# Average many shots into one derived spectrum (streamed from disk)
+@instrumentation.callback
+def average_shots(names):
+    matching, skipped = compatible(index, names)
+    if len(matching) == 0:
+        return
+    time, result = accumulate([index.path(name) for name in matching])
+    name, = unique_names(index.directory, ['average_%d' % result.count], '.npy')
+    save_average(index.path(name), time, result)
+    index.refresh()
+    # Show the average instead of its shots
+    st.session_state['selection'] = [name]
+    st.session_state['skipped'] = skipped
 
 # Mass Calibration
 with st.sidebar:
@@ -145,33 +132,79 @@ with st.sidebar:
     # Baseline Correction
     with st.container(border=True):
         st.write("## Baseline Correction")
-        options = ['No selection']
-        options = [file_name[directory_length+6:] for file_name in all_files]
-        options.insert(0, 'No selection')
-        baseline = st.selectbox("Baseline File", options)
+        options = ['No selection', 'Automatic (from the spectrum)'] + index.names()
+        baseline = st.selectbox("Baseline File", options, help='Automatic: asymmetric least squares estimate, no baseline shot needed')
         if baseline == 'No selection':
             st.session_state['baseline'] = None
+        elif baseline == 'Automatic (from the spectrum)':
+            st.session_state['baseline'] = AUTOMATIC
         else:
-            baseline = all_files[0][:directory_length+6] + baseline
+            baseline = index.path(baseline)
             st.session_state['baseline'] = baseline
 
         multiplier = st.number_input('Multiplier', value=1.)
         lam = 10**st.select_slider(r'$\lambda$ ($10^{x}$)', np.arange(0, 12.1, 1), value=9)
+        persist = st.toggle('Keep smoothed baseline on disk', help='Reuse the smoothed baseline after restarting the app')
+        export_format = st.selectbox('Save as', list(FORMATS))
         col1, col2 = st.columns(2)
         with col1:
             st.button('Apply', key=1, on_click=gen_df)
         with col2:
             st.button('Save', on_click=save)
 
+    # Average Shots
+    with st.container(border=True):
+        st.write("## Average Shots")
+        pattern = st.text_input('Files matching', value='*.npy', help='e.g. run12_*.npy (earlier averages and saved files are left out)')
+        shots = select_shots(index.names(), pattern)
+        st.write('%d files' % len(shots))
+        st.button('Average', on_click=average_shots, args=(shots,), disabled=(len(shots) == 0))
+        if len(st.session_state.get('skipped', [])) > 0:
+            st.write('Skipped %d files with a different sampling' % len(st.session_state['skipped']))
+
 # Actual data selection
-st.session_state['data'] = st.multiselect("Select Data", [file_name[directory_length+6:] for file_name in all_files])
+st.session_state['data'] = st.multiselect("Select Data", index.names(), key='selection')
 
 if st.session_state['data'] != st.session_state['old_data']:
     st.session_state['old_data'] = st.session_state['data']
     gen_df()
+if st.session_state.get('baseline_error') is not None:
+    st.sidebar.error(st.session_state['baseline_error'])
 
 # Plot
+PLOT_WIDTH = 1500   # px, about two points per pixel are sent to the browser
+
+def zoom(spectrum_type):
+    '''
+    Use a box selection in the figure as the new view
+    '''
+    box = st.session_state['plot'].selection['box']
+    if len(box) > 0:
+        st.session_state['view_min_' + spectrum_type] = float(min(box[0]['x']))
+        st.session_state['view_max_' + spectrum_type] = float(max(box[0]['x']))
+
+def reset_view(spectrum_type):
+    st.session_state['view_min_' + spectrum_type] = None
+    st.session_state['view_max_' + spectrum_type] = None
+
+def axis_bounds(spectrum_type):
+    '''
+    Range of the time or mass axis over the selected files, from the directory index
+    '''
+    entries = [index[name] for name in st.session_state['data'] if name in index]
+    if len(entries) == 0:
+        return 0., 0.
+    t_start = max(min(entry['t_start'] for entry in entries), 0) * 1e6    # us
+    t_stop = max(entry['t_stop'] for entry in entries) * 1e6    # us
+    if spectrum_type == 'time':
+        return t_start, t_stop
+    a, k = st.session_state['a'], st.session_state['k']
+    masses = [a * (t_start - k)**2, a * (t_stop - k)**2]
+    return (0. if t_start <= k <= t_stop else min(masses)), max(masses)
+
 def generate_fig():
+    import plotly.graph_objects as go   # only when there is something to plot (app startup)
+
     def prepare_axes(xlabel, ylabel):
         fig.update_layout(
             xaxis_title = xlabel,
@@ -185,15 +218,31 @@ def generate_fig():
             xaxis=dict(showgrid=True),
             uirevision=True)
     
+    # One min/max decimated trace per spectrum, for the shown range only
+    fig = go.Figure()
+    if combination == 'Overlay':
+        for name in st.session_state['store'].spectra:
+            x, y = st.session_state['store'].decimated(name, spectrum_type, view, PLOT_WIDTH)
+            fig.add_trace(go.Scatter(x=x, y=y, mode='lines', name=name, showlegend=True))
+    # Sum, average or difference on a shared mass grid
+    else:
+        edges = grid(*(view if view is not None else axis_bounds('mass')), bin_width)
+        y = combine(list(st.session_state['store'].spectra.values()), edges, COMBINATIONS[combination])
+        indices = minmax(y, 0, len(y), PLOT_WIDTH)
+        fig.add_trace(go.Scatter(x=centres(edges)[indices], y=y[indices], mode='lines', name=combination, showlegend=True))
+
     # Time Spectrum
     if spectrum_type == 'time':
-        fig = px.line(st.session_state['dataframe'], x='time', y='voltage', color='name')
         prepare_axes('time (us)', 'accumulated voltage (V)')
     # Mass Spectrum
     elif spectrum_type == 'mass':
-        fig = px.line(st.session_state['dataframe'], x='mass', y='voltage', color='name')
         prepare_axes('mass (amu)', 'accumulated voltage (V)')
     
+    # Zoom by box selection
+    fig.update_layout(dragmode='select', selectdirection='h')
+    if view is not None:
+        fig.update_xaxes(range=view)
+
     # Add Pointer
     if pointer:
         fig.add_vline(pointer_value, line_dash="dash", line_color="red")
@@ -212,26 +261,68 @@ if st.session_state['data'] != []:
         spectrum_type = st.radio('Spectrum Type', ['Mass','Time'])
         spectrum_type = SPECTRUM_DICT[spectrum_type]
 
+        COMBINATIONS = {'Overlay': None,
+                        'Sum': 'sum',
+                        'Average': 'mean',
+                        'Difference': 'difference'}
+        combination = 'Overlay'
+        if spectrum_type == 'mass':
+            with st.container(border = True):
+                combination = st.radio('Combine', list(COMBINATIONS), horizontal=True,
+                                       help='Difference: the first spectrum minus the average of the others')
+                bin_width = st.number_input('Bin width (amu)', min_value=1e-3, value=0.1, format='%.3f',
+                                            disabled=(combination == 'Overlay'))
+
         with st.container(border = True):
             pointer = st.toggle('Pointer')
             pointer_value = st.number_input('Pointer',
-                                            st.session_state['dataframe'][spectrum_type].iloc[0], 
-                                            st.session_state['dataframe'][spectrum_type].iloc[-1], 
+                                            *axis_bounds(spectrum_type), 
                                             label_visibility='collapsed')  
+
+        with st.container(border = True):
+            st.write('View (or drag a box in the figure)')
+            view_col1, view_col2 = st.columns(2)
+            with view_col1:
+                view_min = st.number_input('From', value=None, key='view_min_' + spectrum_type)
+            with view_col2:
+                view_max = st.number_input('To', value=None, key='view_max_' + spectrum_type)
+            st.button('Reset View', on_click=reset_view, args=(spectrum_type,))
+            view = None
+            if view_min is not None and view_max is not None and view_min < view_max:
+                view = (view_min, view_max)
     ## Figure
     with col1:
-        fig = generate_fig()
+        with instrumentation.span('figure'):
+            fig = generate_fig()
         st.session_state['figure'] = fig
-        st.plotly_chart(fig)
-
-
-
-
-
-
-
-
-
+        with instrumentation.span('plotly_chart'):
+            st.plotly_chart(fig, key='plot', on_select=lambda: zoom(spectrum_type), selection_mode='box')
 
+    ## Peak Table (cached per file, calibration and baseline correction)
+    with st.container(border=True):
+        st.write('### Peak Table')
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            prominence = st.number_input('Minimum prominence (V)', min_value=0., value=1e-3, step=1e-4, format='%.4f')
+        with col2:
+            rel_height = st.number_input('Integrate down to (fraction of the prominence)', min_value=0.05, max_value=1., value=0.95)
+        with col3:
+            show_peaks = st.toggle('Find Peaks')
+        if show_peaks:
+            store = st.session_state['store']
+            files = {name: index.path(name) for name in store.spectra}
+            table = peak_table(files, store.calibration, store.baseline, prominence, rel_height)
+            st.dataframe(table, hide_index=True, use_container_width=True)     # Sort by clicking a column
+            st.download_button('Export', table.to_csv(index=False), file_name='peaks.csv', mime='text/csv')
 
+# Cache statistics of the processing stages
+with st.sidebar:
+    with st.expander('Pipeline cache'):
+        stats = st.session_state['store'].stats()
+        st.dataframe({'stage': list(stats),
+                      'hits': [hits for hits, _ in stats.values()],
+                      'misses': [misses for _, misses in stats.values()]},
+                     hide_index=True, use_container_width=True)
 
+# Performance of this rerun
+instrumentation.panel('Visualiser', instrumentation.end())
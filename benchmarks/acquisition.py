@@ -0,0 +1,98 @@
+"""
+Benchmark: Live Feed acquisition pipeline on a simulated MDO34
+
+Reports the per-stage latency of one Live Feed frame and the resulting frames per second:
+- transfer: 'curve?' from the simulated scope (round-trip latency + bytes / bandwidth)
+- decode: levels to volts and time axis (modules.waveform)
+- peaks: resolution measurement as done before, on the whole record
+- window: resolution measurement of modules.resolution, on a window around the target time
+- plot: decimation and plotly JSON serialisation
+- scope.read: the full read of modules.johanpackage.scope (setup, 7 preamble queries, transfer, decode)
+
+$ python -m benchmarks.acquisition [sizes ...] [--latency S] [--bandwidth B/s]
+"""
+
+import argparse
+import time
+import numpy as np
+import plotly.graph_objects as go
+from scipy.signal import find_peaks, peak_widths
+from modules import waveform
+from modules.simulator import simulated_mdo34
+from modules.decimation import index_range, minmax
+from modules.resolution import measure
+from modules.johanpackage import scope
+
+
+TARGET = 24.6   # us, Co peak of the simulated spectrum
+PLOT_WIDTH = 1500
+
+
+def peak_analysis(time_s, volts, target=TARGET):
+    '''
+    Resolution measurement as the Live Feed used to do it (whole record, whole-sample widths)
+    '''
+    x_data = time_s * 1e6
+    y_data = -volts * 1e3
+    peaks, _ = find_peaks(y_data, prominence=10)
+    the_chosen_one = peaks[np.argmin(np.abs(x_data[peaks] - target))]
+    _, _, lips, rips = peak_widths(y_data, peaks=[the_chosen_one])
+    return target / (2 * (x_data[int(rips[0])] - x_data[int(lips[0])]))
+
+
+def serialise(time_s, volts, x_range=(-20, 180)):
+    '''
+    Plot update as done in the Live Feed
+    '''
+    x_data = time_s * 1e6
+    start, stop = index_range(x_data, *x_range, monotonic=True)
+    shown = minmax(volts, start, stop, PLOT_WIDTH)
+    fig = go.Figure(go.Scatter(x=x_data[shown], y=volts[shown] * 1e3, mode='lines'))
+    return fig.to_json()
+
+
+def timed(function, repeat, *args):
+    '''
+    Median wall time of a number of runs
+
+    ### RETURNS:
+    - (seconds, output of the last run)
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = function(*args)
+        times.append(time.perf_counter() - start)
+    return np.median(times), out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sizes', nargs='*', type=float, default=[1e4, 1e5, 1e6, 1e7])
+    parser.add_argument('--latency', type=float, default=1e-3, help='round-trip latency (s)')
+    parser.add_argument('--bandwidth', type=float, default=40e6, help='transfer rate (bytes/s)')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'points':>10} {'transfer':>9} {'decode':>9} {'peaks':>9} {'window':>9} {'plot':>9} {'frame/s':>8} {'scope.read':>11}   (ms)")
+    for size in map(int, args.sizes):
+        simulated = simulated_mdo34(record_length=size, latency=args.latency, bandwidth=args.bandwidth)
+        session = waveform.scope_session(simulated)
+        session.select('CH1')
+        preamble = session.preamble()
+        out = np.empty(size, dtype=np.float32)
+
+        t_transfer, adc = timed(waveform.transfer, args.repeat, simulated)
+        t_decode, (time_s, volts) = timed(lambda: (waveform.time_axis(preamble, len(adc)), waveform.decode(adc, preamble, out)), args.repeat)
+        t_peaks, _ = timed(peak_analysis, args.repeat, time_s, volts)
+        t_window, _ = timed(measure, args.repeat, time_s, volts, TARGET)
+        t_plot, _ = timed(serialise, args.repeat, time_s, volts)
+        t_legacy, _ = timed(scope.read, args.repeat, 'CH1', simulated)
+
+        total = t_transfer + t_decode + t_window + t_plot
+        print(f"{size:>10} {1e3 * t_transfer:>9.1f} {1e3 * t_decode:>9.1f} {1e3 * t_peaks:>9.1f} {1e3 * t_window:>9.1f} {1e3 * t_plot:>9.1f} "
+              f"{1 / total:>8.1f} {1e3 * t_legacy:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
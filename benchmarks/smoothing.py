@@ -0,0 +1,74 @@
+"""
+Benchmark: banded Cholesky smoothing vs. generic sparse solve
+
+Compares modules.smoothing.smooth with the scipy.sparse/spsolve implementation it replaced.
+
+$ python -m benchmarks.smoothing [sizes ...] [--lam LAM] [--max-sparse N] [--signals N]
+
+spsolve needs several GB for 1e7 points, so by default it is skipped above --max-sparse points.
+The last column smooths --signals signals of the same length with one shared factorisation.
+"""
+
+import argparse
+import time
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
+from modules import smoothing
+
+
+def sparse_smooth(y, lam):
+    '''
+    Reference implementation: builds I + lam*D·Dᵀ explicitly and calls spsolve
+    '''
+    size = len(y)
+    D = sparse.diags([1., -2., 1.], [0, -1, -2], shape=(size, size-2))   # Second order difference matrix
+    D = lam * D.dot(D.transpose())
+    I = sparse.identity(size)
+    return spsolve((I + D).tocsc(), y)
+
+
+def best_of(function, repeat, *args):
+    '''
+    Best wall time of a number of runs
+
+    ### RETURNS:
+    - (seconds, output of the last run)
+    '''
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sizes', nargs='*', type=float, default=[1e5, 1e6, 1e7])
+    parser.add_argument('--lam', type=float, default=1e9)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--max-sparse', type=float, default=3e6, help='largest size to run spsolve on')
+    parser.add_argument('--signals', type=int, default=8, help='number of signals smoothed at once')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'points':>10} {'spsolve (s)':>12} {'banded (s)':>12} {'speed-up':>9} {'max rel. diff':>14} {'%d signals (s)' % args.signals:>15}")
+    for size in map(int, args.sizes):
+        # Slowly varying background with noise, like a baseline shot
+        x = np.linspace(0, 1, size)
+        y = 1e-3 * np.sin(6 * x) + rng.normal(0, 1e-4, size)
+
+        t_banded, z_banded = best_of(smoothing.smooth, args.repeat, y, args.lam)
+        ys = np.column_stack([y] * args.signals)
+        t_many, _ = best_of(lambda: smoothing.solve(smoothing.factorise(size, args.lam), ys), args.repeat)
+        if size > args.max_sparse:
+            print(f"{size:>10} {'skipped':>12} {t_banded:>12.3f} {'':>9} {'':>14} {t_many:>15.3f}")
+            continue
+        t_sparse, z_sparse = best_of(sparse_smooth, args.repeat, y, args.lam)
+        diff = np.max(np.abs(z_sparse - z_banded)) / np.max(np.abs(z_sparse))
+        print(f"{size:>10} {t_sparse:>12.3f} {t_banded:>12.3f} {t_sparse / t_banded:>8.1f}x {diff:>14.2e} {t_many:>15.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Benchmark: cold startup of the app
+
+Imports what every page imports, each in a fresh interpreter (so nothing is cached in
+sys.modules), and reports the best wall time and which heavy dependencies got loaded on the way:
+SciPy, Plotly and tkinter should only be imported once they are needed, and pyvisa must not list
+the instruments at import time.
+
+$ python -m benchmarks.startup [--repeat N]
+"""
+
+import sys
+import json
+import argparse
+import subprocess
+
+
+TARGETS = {
+    'modules': 'import modules',
+    'visualiser': 'from modules.spectra import spectrum_store; from modules.index import get_index; '
+                  'from modules.peaks import peak_table; from modules.export import export; '
+                  'from modules.accumulation import accumulate; from modules.rebinning import combine; '
+                  'from modules.decimation import minmax; from modules import instrumentation; import modules',
+    'calibration tool': 'from modules.autocalibration import auto_calibrate; import plotly.graph_objects',
+    'live feed': 'import modules.johanpackage.scope; from modules import waveform; '
+                 'from modules.acquisition import acquisition_worker; from modules.recording import stream_recorder; '
+                 'from modules.resolution import measure; from modules.simulator import simulated_mdo34',
+}
+HEAVY = ['scipy', 'plotly', 'tkinter', 'pandas', 'pyvisa']
+
+PROBE = '''
+import sys, time, json
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+scope = sys.modules.get('modules.johanpackage.scope')
+print(json.dumps({{'seconds': seconds,
+                  'loaded': [name for name in {heavy!r} if name in sys.modules],
+                  'discovered': scope is not None and scope._manager is not None}}))
+'''
+
+
+def probe(statement):
+    '''
+    Import time of a statement in a fresh interpreter
+
+    ### RETURNS:
+    - dictionary with the seconds, the heavy modules that were loaded and whether the VISA
+      resource manager was created
+    '''
+    output = subprocess.run([sys.executable, '-c', PROBE.format(statement=statement, heavy=HEAVY)],
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'page':>18} {'import (s)':>11} {'VISA':>6}  loaded")
+    for name, statement in TARGETS.items():
+        results = [probe(statement) for _ in range(args.repeat)]
+        best = min(result['seconds'] for result in results)
+        discovered = 'yes' if results[-1]['discovered'] else 'no'
+        print(f"{name:>18} {best:>11.3f} {discovered:>6}  {', '.join(results[-1]['loaded'])}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Benchmark: waveform decoding throughput
+
+Decodes synthetic IEEE 488.2 curve payloads (as sent by the scope for 'curve?') with the path of
+modules.johanpackage.scope.read and with modules.waveform.
+
+$ python -m benchmarks.waveform [sizes ...] [--width 1|2]
+"""
+
+import argparse
+import time
+from struct import unpack
+import numpy as np
+from pyvisa.util import to_ieee_block, from_ieee_block
+from modules import waveform
+
+
+PREAMBLE = {'ymult': 4e-4, 'yzero': 0., 'yoff': 128., 'xincr': 4e-10, 'nr_pt': 0, 'xzero': -4e-6, 'pt_off': 0}
+
+
+def payload(size, width):
+    '''
+    Synthetic curve transfer of size points
+    '''
+    rng = np.random.default_rng(0)
+    levels = rng.integers(0, 2**(8 * width), size).astype('>u%d' % width)
+    return bytes(to_ieee_block(levels.tobytes(), datatype='B'))
+
+
+def scope_read_path(block, preamble):
+    '''
+    Decoding as done in scope.read (8-bit only)
+    '''
+    ADC_wave = from_ieee_block(block, datatype='b', container=np.array)
+    total_time = preamble['xincr'] * preamble['nr_pt']
+    t_start = (-preamble['pt_off'] * preamble['xincr']) + preamble['xzero']
+    t_stop = t_start + total_time
+    ADC_wave = np.array(unpack('%sB' % len(ADC_wave), ADC_wave))
+    Volts = (ADC_wave - preamble['yoff']) * preamble['ymult'] + preamble['yzero']
+    scaled_time = np.arange(t_stop - preamble['xincr'] * len(Volts), t_stop, preamble['xincr'])
+    return np.transpose([scaled_time, Volts])
+
+
+def waveform_path(block, preamble, width, out):
+    '''
+    Decoding as done in waveform.read
+    '''
+    adc = from_ieee_block(block, datatype=waveform.DTYPES[width], is_big_endian=True, container=np.array)
+    volts = waveform.decode(adc, preamble, out)
+    return waveform.time_axis(preamble, len(volts)), volts
+
+
+def best_of(function, repeat, *args):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sizes', nargs='*', type=float, default=[1e4, 1e5, 1e6, 1e7])
+    parser.add_argument('--width', type=int, default=1, choices=[1, 2])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'points':>10} {'scope.read (MB/s)':>18} {'waveform (MB/s)':>16} {'speed-up':>9}")
+    for size in map(int, args.sizes):
+        block = payload(size, args.width)
+        preamble = dict(PREAMBLE, nr_pt=size)
+        megabytes = size * args.width / 1e6
+        out = np.empty(size, dtype=np.float32)
+
+        t_new, (time_new, volts_new) = best_of(waveform_path, args.repeat, block, preamble, args.width, out)
+        if args.width == 1:
+            t_old, old = best_of(scope_read_path, args.repeat, block, preamble)
+            assert len(old) == len(volts_new) and np.allclose(old[:, 1], volts_new, atol=1e-6)
+            print(f"{size:>10} {megabytes / t_old:>18.1f} {megabytes / t_new:>16.1f} {t_old / t_new:>8.1f}x")
+        else:
+            print(f"{size:>10} {'n/a':>18} {megabytes / t_new:>16.1f}")
+
+
+if __name__ == '__main__':
+    main()
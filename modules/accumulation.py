@@ -0,0 +1,148 @@
+'''
+Out-of-core averaging of many shots
+
+The records are memory-mapped and read by a small thread pool, with only a bounded number of
+reads in flight, while the main thread folds every shot into a running mean and variance
+(Welford). Memory therefore scales with the record length, not with the number of shots.
+Only records with the same sampling as the first one (number of points, time step and start
+time, from the directory index) are averaged; the others are skipped.
+'''
+
+# Imports
+import os
+from fnmatch import fnmatch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from modules import instrumentation
+
+
+DERIVED = ['average_*', '*_adj*']    # outputs of the app, never averaged with the shots
+
+
+def select_shots(names, pattern):
+    '''
+    Names matching a glob pattern, without earlier averages and exports (see DERIVED)
+    '''
+    return [name for name in names
+            if fnmatch(name, pattern) and not any(fnmatch(name, derived) for derived in DERIVED)]
+
+
+class accumulator:
+    '''
+    Running mean and variance of equally long signals
+    '''
+
+    def __init__(self, points):
+        '''
+        ### ARGUMENTS:
+        - points: length of every signal
+        '''
+        self.count = 0
+        self.mean = np.zeros(points)
+        self._m2 = np.zeros(points)     # sum of squared deviations from the mean
+        return
+
+
+    def add(self, signal):
+        '''
+        Fold one signal into the running statistics
+        '''
+        self.count += 1
+        delta = signal - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (signal - self.mean)
+        return
+
+
+    @property
+    def variance(self):
+        # Sample variance (0 for fewer than two signals)
+        if self.count < 2:
+            return np.zeros_like(self.mean)
+        return self._m2 / (self.count - 1)
+
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+def compatible(index, names):
+    '''
+    Split files into those sampled like the first one and the rest
+
+    ### ARGUMENTS:
+    - index: directory_index of the files
+    - names: file names
+
+    ### RETURNS:
+    - list of names that can be averaged, list of names that are skipped
+    '''
+    names = [name for name in names if name in index]
+    if len(names) == 0:
+        return [], []
+    reference = index[names[0]]
+    sampling = lambda entry: (entry['points'], entry['dt'], entry['t_start'])
+    matching = [name for name in names if sampling(index[name]) == sampling(reference)]
+    skipped = [name for name in names if sampling(index[name]) != sampling(reference)]
+    return matching, skipped
+
+
+def read_voltage(path):
+    '''
+    Voltage column of a record, copied out of its memory map
+    '''
+    return np.array(np.load(path, mmap_mode='r')[:, 1], dtype=np.float64)
+
+
+@instrumentation.timed
+def accumulate(paths, workers=4, progress=None):
+    '''
+    Average equally sampled records without holding them in memory
+
+    ### ARGUMENTS:
+    - paths: paths to the records (all sampled like the first one, see compatible)
+    - workers: number of reading threads
+    - progress: optional callable receiving the number of records done and the total
+
+    ### RETURNS:
+    - time: time axis of the first record (s)
+    - accumulator with the mean and variance of the voltage (V)
+    '''
+    time = np.array(np.load(paths[0], mmap_mode='r')[:, 0])
+    result = accumulator(len(time))
+    with ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        remaining = iter(paths)
+        # Keep at most two reads per thread in flight
+        for path in remaining:
+            pending.append(executor.submit(read_voltage, path))
+            if len(pending) >= 2 * workers:
+                break
+        while len(pending) > 0:
+            result.add(pending.popleft().result())
+            for path in remaining:
+                pending.append(executor.submit(read_voltage, path))
+                break
+            if progress is not None:
+                progress(result.count, len(paths))
+    return time, result
+
+
+def save_average(path, time, result):
+    '''
+    Write an average as a record the visualiser opens like any other file
+
+    The columns are the time (s), the mean voltage (V) and the standard deviation of the voltage (V)
+
+    ### ARGUMENTS:
+    - path: output .npy file
+    - time: time axis (s)
+    - result: accumulator
+
+    ### RETURNS:
+    - absolute path of the written file
+    '''
+    np.save(path, np.column_stack((time, result.mean, result.std)))
+    return os.path.abspath(path)
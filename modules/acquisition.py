@@ -0,0 +1,231 @@
+'''
+Background acquisition from the scopes
+
+Every scope gets its own worker thread that keeps pulling records (see modules.waveform.scope_session)
+as soon as the acquisition counter shows a completely new (averaged) record, and writes them into
+a small ring of preallocated frames (and, while recording, hands them to every
+modules.recording.stream_recorder attached to it). The acquisition cadence is set by the
+instruments, independent of the Streamlit script and the browser; the UI only renders the latest
+frame. A worker can be shared by several sessions: it runs while at least one of them asks for it.
+'''
+
+# Imports
+import time
+import threading
+from collections import namedtuple, deque
+from contextlib import contextmanager
+import numpy as np
+from modules import instrumentation
+
+
+frame = namedtuple('frame', ['sequence', 'timestamp', 'time', 'volts'])
+
+
+class frame_ring:
+    '''
+    Fixed number of preallocated float32 frames, written by one thread and read by others
+
+    The writer never overwrites the latest frame or a frame that is pinned by a reader.
+    '''
+
+    def __init__(self, capacity=3):
+        '''
+        ### ARGUMENTS:
+        - capacity: number of frames (at least 2, one extra per reader that may hold a frame)
+        '''
+        self.capacity = max(capacity, 2)
+        self.count = 0      # number of published frames
+        self._buffers = [None] * self.capacity
+        self._times = [None] * self.capacity
+        self._volts = [None] * self.capacity
+        self._stamps = [0.] * self.capacity
+        self._sequence = [0] * self.capacity
+        self._pins = [0] * self.capacity
+        self._latest = -1
+        self._condition = threading.Condition()
+        return
+
+
+    def claim(self, length):
+        '''
+        Writer: reserve the oldest free frame with room for length points
+
+        ### RETURNS:
+        - slot number and its float32 buffer
+        '''
+        with self._condition:
+            while True:
+                free = [slot for slot in range(self.capacity) if slot != self._latest and self._pins[slot] == 0]
+                if len(free) > 0:
+                    break
+                self._condition.wait()
+            slot = min(free, key=lambda slot: self._sequence[slot])
+            self._sequence[slot] = 0
+        if self._buffers[slot] is None or len(self._buffers[slot]) < length:
+            self._buffers[slot] = np.empty(length, dtype=np.float32)
+        return slot, self._buffers[slot]
+
+
+    def publish(self, slot, time_axis, volts):
+        '''
+        Writer: make a claimed frame the latest one
+
+        ### ARGUMENTS:
+        - slot: claimed slot
+        - time_axis: time of every point (s)
+        - volts: the valid part of the slot's buffer
+        '''
+        with self._condition:
+            self.count += 1
+            self._times[slot] = time_axis
+            self._volts[slot] = volts
+            self._stamps[slot] = time.time()
+            self._sequence[slot] = self.count
+            self._latest = slot
+            self._condition.notify_all()
+        return
+
+
+    def wait(self, after, timeout=None):
+        '''
+        Block until a frame newer than sequence number after is published
+
+        ### RETURNS:
+        - True if there is a newer frame
+        '''
+        with self._condition:
+            return self._condition.wait_for(lambda: self.count > after, timeout)
+
+
+    @contextmanager
+    def latest(self, after=0):
+        '''
+        Reader: pin the latest frame while it is being used
+
+        ### ARGUMENTS:
+        - after: only return frames with a higher sequence number
+
+        ### YIELDS:
+        - frame(sequence, timestamp, time, volts), or None if there is no newer frame
+        '''
+        with self._condition:
+            slot = self._latest
+            if slot < 0 or self._sequence[slot] <= after:
+                slot = None
+            else:
+                self._pins[slot] += 1
+                latest = frame(self._sequence[slot], self._stamps[slot], self._times[slot], self._volts[slot])
+        try:
+            yield None if slot is None else latest
+        finally:
+            if slot is not None:
+                with self._condition:
+                    self._pins[slot] -= 1
+                    self._condition.notify_all()
+        return
+
+
+class acquisition_worker:
+    '''
+    Background thread that continuously reads one scope session into a frame_ring
+    '''
+
+    def __init__(self, session, channel='CH1', capacity=3, timeout=1.):
+        '''
+        ### ARGUMENTS:
+        - session: modules.waveform.scope_session
+        - channel: scope channel to read
+        - capacity: number of frames in the ring
+        - timeout: maximum time to wait for a fresh record before checking for pause/close (s)
+        '''
+        self.session = session
+        self.channel = channel
+        self.timeout = timeout
+        self.ring = frame_ring(capacity)
+        self.recorders = {}     # owner -> modules.recording.stream_recorder that receives every frame
+        self.profile = False    # time the steps of every frame (see modules.instrumentation)
+        self.spans = deque(maxlen=500)   # span records of the last profiled frames
+        self.error = None
+        self._active = threading.Event()
+        self._interrupt = threading.Event()
+        self._owners = set()    # who asked the worker to run
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='acquisition', daemon=True)
+        self._thread.start()
+        return
+
+
+    @property
+    def running(self):
+        return self._active.is_set()
+
+
+    @property
+    def owners(self):
+        return len(self._owners)
+
+
+    def start(self, owner=None):
+        '''
+        Run on behalf of an owner (e.g. a session)
+        '''
+        with self._lock:
+            if self._closed:
+                return
+            self._owners.add(owner)
+            self.error = None
+            self._interrupt.clear()
+            self._active.set()
+        return
+
+
+    def pause(self, owner=None):
+        '''
+        Stop running on behalf of an owner: the worker pauses once nobody asks for it
+        '''
+        with self._lock:
+            self._owners.discard(owner)
+            if len(self._owners) == 0:
+                self._active.clear()
+                self._interrupt.set()
+        return
+
+
+    def _halt(self):
+        # Pause for every owner
+        with self._lock:
+            self._owners.clear()
+            self._active.clear()
+            self._interrupt.set()
+        return
+
+
+    def close(self):
+        self._closed = True
+        self.error = RuntimeError('disconnected')
+        self._halt()
+        self._thread.join()
+        return
+
+
+    def _run(self):
+        while not self._closed:
+            if not self._active.wait(0.2):
+                continue
+            try:
+                if not self.session.wait_for_record(self.timeout, stop=self._interrupt):
+                    continue
+                instrumentation.begin('frame', self.profile)
+                slot, buffer = self.ring.claim(self.session.preamble()['nr_pt'])
+                time_axis, volts = self.session.read(self.channel, out=buffer)
+                stamp = time.time()
+                for recorder in list(self.recorders.values()):
+                    recorder.submit(stamp, time_axis, volts)
+                self.ring.publish(slot, time_axis, volts)
+                self.spans.extend(instrumentation.end())
+            except Exception as error:
+                # Report to the UI and stop until restarted
+                self.error = error
+                self._halt()
+        return
@@ -0,0 +1,211 @@
+'''
+Automatic mass calibration from the peak library (masses.npy)
+
+The calibration m = a(t-k)^2 is linear in the square root of the mass: sqrt(m) = sqrt(a) (t - k).
+Assigning two detected peaks to two library masses therefore fixes a candidate (a, k) in closed
+form. Candidates are generated for pairs of the strongest peaks and all pairs of library masses,
+only those close to the current calibration are kept, and each is scored (vectorised) by the
+summed height of the detected peaks that land on a library mass, so a few strong real peaks
+outweigh many noise peaks that happen to sit near one of the (many) library masses. Equal scores
+go to the candidate closest to the current calibration. The best candidate seeds a linear fit of
+sqrt(m) against t over its matched peaks, which in turn seeds the final least-squares fit of
+a(t-k)^2. Fewer than MIN_MATCHES matched peaks give no calibration at all.
+'''
+
+# Imports
+import numpy as np
+import pandas as pd
+from scipy.optimize import curve_fit
+from modules.peaks import detect
+from modules import instrumentation
+
+
+LIBRARY_FILE = 'masses.npy'
+MIN_MATCHES = 3     # matched peaks needed to accept a calibration
+
+_libraries = {}     # path -> (names, masses) sorted by mass
+
+
+def load_library(path=LIBRARY_FILE):
+    '''
+    Peak identifiers and their (positive) masses, sorted by mass (read once per path)
+
+    Entries without a positive mass (e.g. bare electrons) cannot be a time-of-flight peak and are
+    left out.
+
+    ### ARGUMENTS:
+    - path: path to the library (a pickled dictionary of name -> mass (amu))
+
+    ### RETURNS:
+    - names: array of peak identifiers
+    - masses: array of masses (amu), increasing
+    '''
+    if path not in _libraries:
+        library = np.load(path, allow_pickle=True).item()
+        names = np.array(list(library.keys()))
+        masses = np.array(list(library.values()), dtype=np.float64)
+        positive = masses > 0
+        names, masses = names[positive], masses[positive]
+        order = np.argsort(masses, kind='stable')
+        _libraries[path] = (names[order], masses[order])
+    return _libraries[path]
+
+
+def nearest(masses, predicted):
+    '''
+    Index of the library mass closest to every predicted mass
+
+    ### ARGUMENTS:
+    - masses: increasing library masses
+    - predicted: array (of any shape) of masses
+
+    ### RETURNS:
+    - array of indices into masses, shaped like predicted
+    '''
+    right = np.clip(np.searchsorted(masses, predicted), 1, len(masses) - 1)
+    left = right - 1
+    return np.where(predicted - masses[left] < masses[right] - predicted, left, right)
+
+
+def candidates(t_anchor, sqrt_masses, bounds):
+    '''
+    Closed-form (a, k) of every assignment of two anchor peaks to two library masses
+
+    ### ARGUMENTS:
+    - t_anchor: times of the anchor peaks (us)
+    - sqrt_masses: square roots of the increasing library masses
+    - bounds: ((a_min, a_max), (k_min, k_max)) of the candidates that are kept
+
+    ### RETURNS:
+    - a, k: arrays of the candidate calibrations
+    '''
+    (a_min, a_max), (k_min, k_max) = bounds
+    # Library pairs (p < q): later peaks have the larger mass
+    p, q = np.triu_indices(len(sqrt_masses), k=1)
+    difference = sqrt_masses[q] - sqrt_masses[p]
+    a, k = [], []
+    t_anchor = np.sort(t_anchor)
+    for i, j in zip(*np.triu_indices(len(t_anchor), k=1)):
+        dt = t_anchor[j] - t_anchor[i]
+        if dt <= 0:
+            continue
+        # Only the library pairs whose spacing gives an a within bounds
+        keep = (difference >= np.sqrt(a_min) * dt) & (difference <= np.sqrt(a_max) * dt)
+        sqrt_a = difference[keep] / dt
+        offset = t_anchor[i] - sqrt_masses[p[keep]] / sqrt_a
+        keep = (offset >= k_min) & (offset <= k_max)
+        a.append(sqrt_a[keep]**2)
+        k.append(offset[keep])
+    if len(a) == 0:
+        return np.empty(0), np.empty(0)
+    return np.concatenate(a), np.concatenate(k)
+
+
+def score(t_peaks, heights, masses, a, k, tolerance, chunk=65536):
+    '''
+    Summed height and number of the peaks that match a library mass, and their squared mass error,
+    per candidate
+
+    ### ARGUMENTS:
+    - t_peaks: times of the detected peaks (us)
+    - heights: heights of the detected peaks (V)
+    - masses: increasing library masses
+    - a, k: arrays of candidate calibrations
+    - tolerance: maximum distance to a library mass (amu)
+    - chunk: number of candidates scored at once (bounds the memory)
+
+    ### RETURNS:
+    - weight: summed height of the matched peaks per candidate
+    - matches: number of matched peaks per candidate
+    - error: sum of the squared mass errors of the matched peaks per candidate
+    '''
+    weight = np.empty(len(a))
+    matches = np.empty(len(a), dtype=np.int64)
+    error = np.empty(len(a))
+    for start in range(0, len(a), chunk):
+        stop = start + chunk
+        predicted = a[start:stop, None] * (t_peaks[None, :] - k[start:stop, None])**2
+        residual = predicted - masses[nearest(masses, predicted)]
+        # Peaks before k would map onto the wrong branch of the parabola
+        matched = (np.abs(residual) <= tolerance) & (t_peaks[None, :] > k[start:stop, None])
+        weight[start:stop] = np.where(matched, heights[None, :], 0).sum(axis=1)
+        matches[start:stop] = matched.sum(axis=1)
+        error[start:stop] = np.where(matched, residual**2, 0).sum(axis=1)
+    return weight, matches, error
+
+
+@instrumentation.timed
+def auto_calibrate(time, voltage, calibration, library=LIBRARY_FILE, prominence=0.01, anchors=8,
+                   tolerance=0.5, a_range=0.5, k_range=1.):
+    '''
+    Calibrate a time spectrum against the peak library
+
+    ### ARGUMENTS:
+    - time: time axis (us)
+    - voltage: baseline corrected, inverted voltage (V)
+    - calibration: current (a, k), the centre of the search
+    - library: path to the peak library
+    - prominence: minimum peak prominence (V)
+    - anchors: number of strongest peaks used to generate candidates
+    - tolerance: maximum distance between a peak and its library mass (amu)
+    - a_range: candidates have a within a(1 -/+ a_range)
+    - k_range: candidates have k within k -/+ k_range (us)
+
+    ### RETURNS:
+    - (a, k) of the fitted calibration, or None if fewer than MIN_MATCHES peaks could be matched
+    - DataFrame with one row per matched peak and the columns name, time (us), mass (amu),
+      fitted mass (amu) and residual (amu)
+    '''
+    names, masses = load_library(library)
+    peaks = detect(time, voltage, calibration, prominence)
+    empty = pd.DataFrame(columns=['name', 'time', 'mass', 'fitted', 'residual'])
+    if len(peaks['time']) < 2:
+        return None, empty
+
+    # Candidates from pairs of the strongest peaks
+    a0, k0 = calibration
+    bounds = ((a0 * (1 - a_range), a0 * (1 + a_range)), (k0 - k_range, k0 + k_range))
+    strongest = np.argsort(peaks['height'])[::-1][:anchors]
+    a, k = candidates(peaks['time'][strongest], np.sqrt(masses), bounds)
+    if len(a) == 0:
+        return None, empty
+    weight, matches, error = score(peaks['time'], peaks['height'], masses, a, k, tolerance)
+    # Strongest matched peaks first, then closest to the current calibration, then smallest error
+    distance = np.abs(a / a0 - 1) / a_range + np.abs(k - k0) / k_range
+    best = np.lexsort((error, distance, -weight))[0]
+    if matches[best] < MIN_MATCHES:
+        return None, empty
+
+    # Matched peaks of the best candidate
+    t = peaks['time']
+    t = t[t > k[best]]
+    assigned = nearest(masses, a[best] * (t - k[best])**2)
+    residual = np.abs(a[best] * (t - k[best])**2 - masses[assigned])
+    matched = residual <= tolerance
+    t, assigned, residual = t[matched], assigned[matched], residual[matched]
+    # A library mass is only assigned to its closest peak
+    order = np.argsort(residual, kind='stable')
+    _, unique = np.unique(assigned[order], return_index=True)
+    unique = np.sort(order[unique])
+    t, assigned = t[unique], assigned[unique]
+    if len(t) < MIN_MATCHES:
+        return None, empty
+    m = masses[assigned]
+
+    # Linear fit of sqrt(m) against t seeds the fit of a(t-k)^2
+    slope, intercept = np.polyfit(t, np.sqrt(m), 1)
+    seed = [slope**2, -intercept / slope]
+    if len(t) > 2:
+        toFit = lambda x, a, k: a*(x-k)**2
+        try:
+            seed, _ = curve_fit(toFit, t, m, p0=seed)
+        except RuntimeError:
+            pass
+    a_fit, k_fit = float(seed[0]), float(seed[1])
+
+    fitted = a_fit * (t - k_fit)**2
+    return (a_fit, k_fit), pd.DataFrame({'name': names[assigned],
+                                         'time': t,
+                                         'mass': m,
+                                         'fitted': fitted,
+                                         'residual': fitted - m})
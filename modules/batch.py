@@ -0,0 +1,258 @@
+"""
+Headless batch processing: load -> calibrate -> baseline correct -> export
+
+Processes every record in a directory (or matching a glob) in a pool of worker processes,
+without the web app. The calibration is taken from defaults.toml unless it is given as flags.
+Records that were already processed (an output file newer than the record exists, written with
+the same settings) are skipped, so an interrupted run can simply be started again. The settings
+of every output are kept next to it in <name><suffix>.json.
+
+$ python -m modules.batch DIRECTORY_OR_GLOB [...] [--baseline FILE] [--lam LAM] [--multiplier M]
+                                                    [-a A] [-k K] [--output DIR] [--processes N]
+"""
+
+# Imports
+import os
+import re
+import sys
+import json
+import glob
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import toml
+from modules import cache
+from modules.calibration import load_data, AUTOMATIC
+from modules.index import read_metadata
+from modules.recording import SIDECARS
+
+
+SUFFIX = '_adj'
+
+_baseline = None    # smoothed baseline in a worker process
+
+
+def find_records(inputs, suffix=SUFFIX):
+    '''
+    Records in the given directories or matching the given globs
+
+    Only (time, voltage) records are kept, like in the directory index: outputs (<name><suffix>.npy
+    and the <name>_adj_<n>.npy exports of the web app), the frames and acquisition times of a
+    recording (<name>_frames.npy, <name>_timestamps.npy) and anything else that is not a 2-D
+    record are left out.
+
+    ### ARGUMENTS:
+    - inputs: directories and/or glob patterns
+    - suffix: appended to the names of the outputs
+
+    ### RETURNS:
+    - sorted list of paths
+    '''
+    suffixes = '|'.join(re.escape(s) for s in {suffix, SUFFIX})    # also the exports of the web app
+    derived = re.compile('((' + suffixes + r')(_\d+)?|' + '|'.join(SIDECARS) + r')\.npy$')
+    paths = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.npy')
+        paths.update(path for path in glob.glob(pattern) if os.path.isfile(path))
+    return sorted(path for path in paths
+                  if derived.search(path) is None and read_metadata(path, os.stat(path)) is not None)
+
+
+def output_path(path, output=None, suffix=SUFFIX):
+    '''
+    Output file of a record: <name><suffix>.npy, next to the record or in the output directory
+    '''
+    directory, name = os.path.split(path)
+    return os.path.join(output if output is not None else directory, os.path.splitext(name)[0] + suffix + '.npy')
+
+
+def settings_path(target):
+    '''
+    File with the settings an output was written with: <output without .npy>.json
+    '''
+    return os.path.splitext(target)[0] + '.json'
+
+
+def output_settings(calibration, baseline=None, mass=False):
+    '''
+    Settings that determine the content of an output, as stored next to it
+
+    ### ARGUMENTS:
+    - calibration, baseline: see run
+    - mass: see process
+
+    ### RETURNS:
+    - dictionary that survives a round trip through JSON unchanged
+    '''
+    a, k = calibration
+    if baseline is None:
+        correction = None
+    elif baseline[0] == AUTOMATIC:
+        correction = {'file': 'auto', 'lam': float(baseline[1]), 'multiplier': float(baseline[2])}
+    else:
+        # A rewritten baseline file changes the output as well
+        file, lam, multiplier = baseline
+        correction = {'file': os.path.abspath(file), 'mtime': os.path.getmtime(file),
+                      'lam': float(lam), 'multiplier': float(multiplier)}
+    return {'a': float(a), 'k': float(k), 'baseline': correction, 'mass': bool(mass)}
+
+
+def done(path, output=None, suffix=SUFFIX, settings=None):
+    '''
+    Whether a record already has an output that is newer than the record
+
+    ### ARGUMENTS:
+    - path, output, suffix: see process
+    - settings: also require the output to be written with these settings (see output_settings)
+    '''
+    target = output_path(path, output, suffix)
+    if not (os.path.isfile(target) and os.path.getmtime(target) >= os.path.getmtime(path)):
+        return False
+    if settings is None:
+        return True
+    try:
+        with open(settings_path(target), 'r') as f:
+            return json.load(f) == settings
+    except (OSError, ValueError):
+        return False
+
+
+def process(path, calibration, output=None, suffix=SUFFIX, mass=False, settings=None):
+    '''
+    Calibrate, baseline correct and export one record (runs in a worker process)
+
+    ### ARGUMENTS:
+    - path: path to the record
+    - calibration: (a, k) of the mass calibration
+    - output: output directory (None: next to the record)
+    - suffix: appended to the name of the record
+    - mass: add the mass axis (amu) as a third column
+    - settings: written next to the output (see output_settings), None to write none
+
+    ### RETURNS:
+    - path of the written file
+    '''
+    data = load_data(path, calibration, lazy=True)
+    if isinstance(_baseline, tuple):
+        lam, multiplier = _baseline
+        data.baseline_correction(lam, multiplier, AUTOMATIC)
+    elif _baseline is not None:
+        data.subtract_baseline(_baseline)     # a clear error for a record of another length
+    record = data.record()
+    if mass:
+        record = np.column_stack((record, data.mass))
+    # Write atomically, so an interrupted run never leaves a partial output behind
+    target = output_path(path, output, suffix)
+    temporary = target + '.tmp'
+    with open(temporary, 'wb') as f:
+        np.save(f, record)
+    os.replace(temporary, target)
+    if settings is not None:
+        with open(temporary, 'w') as f:
+            json.dump(settings, f)
+        os.replace(temporary, settings_path(target))
+    return target
+
+
+def _initialise_worker(baseline):
+    global _baseline
+    _baseline = baseline
+    return
+
+
+def run(paths, calibration, baseline=None, output=None, suffix=SUFFIX, mass=False, processes=None, log=sys.stdout):
+    '''
+    Process records in a pool of worker processes
+
+    ### ARGUMENTS:
+    - paths: paths to the records
+    - calibration: (a, k) of the mass calibration
+    - baseline: (baseline file or AUTOMATIC, lambda, multiplier) of the baseline correction, or None
+    - output, suffix, mass: see process
+    - processes: number of worker processes (None: number of CPUs)
+    - log: stream for the progress output (None: silent)
+
+    ### RETURNS:
+    - list of (path, error) of the records that failed
+    '''
+    recorded = output_settings(calibration, baseline, mass)
+    # The baseline is smoothed once and sent to every worker once (or estimated per record)
+    if baseline is None:
+        smoothed = None
+    elif baseline[0] == AUTOMATIC:
+        smoothed = baseline[1:]
+    else:
+        smoothed = cache.smoothed_baseline(*baseline)
+    failed = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(processes, initializer=_initialise_worker, initargs=(smoothed,)) as executor:
+        futures = {executor.submit(process, path, calibration, output, suffix, mass, recorded): path for path in paths}
+        for i, future in enumerate(as_completed(futures), start=1):
+            path = futures[future]
+            try:
+                future.result()
+                status = 'ok'
+            except Exception as error:     # one bad record should not stop an overnight run
+                failed.append((path, error))
+                status = 'failed: %s' % error
+            if log is not None:
+                rate = i / (time.perf_counter() - start)
+                print(f'[{i}/{len(paths)}] {os.path.basename(path)} {status} ({rate:.1f} files/s)', file=log, flush=True)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help='directories and/or glob patterns of records')
+    parser.add_argument('-a', type=float, help='calibration a (default: defaults.toml)')
+    parser.add_argument('-k', type=float, help='calibration k (default: defaults.toml)')
+    parser.add_argument('--defaults', default='defaults.toml', help='settings file of the web app')
+    parser.add_argument('--baseline', help="baseline file, or 'auto' to estimate it from every record (default: no baseline correction)")
+    parser.add_argument('--lam', type=float, default=1e9, help='smoothness of the baseline')
+    parser.add_argument('--multiplier', type=float, default=1., help='scaling of the baseline')
+    parser.add_argument('--output', help='output directory (default: next to the records)')
+    parser.add_argument('--suffix', default=SUFFIX, help='appended to the names of the outputs')
+    parser.add_argument('--mass', action='store_true', help='add the mass axis as a third column')
+    parser.add_argument('--processes', type=int, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--force', action='store_true', help='also process records that were already processed')
+    args = parser.parse_args()
+
+    # Calibration
+    a, k = args.a, args.k
+    if a is None or k is None:
+        try:
+            with open(args.defaults, 'r') as f:
+                defaults = toml.load(f)
+        except OSError:
+            parser.error('no calibration given and %s not found' % args.defaults)
+        a = defaults['calibration']['a'] if a is None else a
+        k = defaults['calibration']['k'] if k is None else k
+
+    # Records
+    if args.output is not None:
+        os.makedirs(args.output, exist_ok=True)
+    paths = find_records(args.inputs, args.suffix)
+    if args.baseline not in (None, 'auto'):
+        paths = [path for path in paths if os.path.abspath(path) != os.path.abspath(args.baseline)]
+    if args.baseline is None:
+        baseline = None
+    else:
+        baseline = (AUTOMATIC if args.baseline == 'auto' else args.baseline, args.lam, args.multiplier)
+    # Outputs written with other settings (calibration, baseline, lambda, ...) are redone
+    current = output_settings((a, k), baseline, args.mass)
+    todo = [path for path in paths if args.force or not done(path, args.output, args.suffix, current)]
+    print(f'{len(paths)} records, {len(paths) - len(todo)} already processed, a = {a}, k = {k}', flush=True)
+    if len(todo) == 0:
+        return
+
+    failed = run(todo, (a, k), baseline, args.output, args.suffix, args.mass, args.processes)
+    if len(failed) > 0:
+        print(f'{len(failed)} records failed', file=sys.stderr)
+        sys.exit(1)
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+'''
+Caching of expensive intermediate results
+
+Smoothed baselines only depend on the baseline file (and its modification time) and on lambda.
+The multiplier scales the smoothed baseline linearly, so it is applied after the cache lookup
+and does not need to be part of the key. The factorisation of the smoothing system only depends
+on the record length and lambda, so it is shared by all baselines of the same length.
+Baselines estimated from a spectrum itself are kept per (file, mtime, lambda) as well.
+Every cache is bounded by the memory of its arrays as well as by its number of entries, since a
+single entry of a long record can take hundreds of MB.
+'''
+
+# Imports
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from modules import smoothing
+from modules import calibration
+from modules import instrumentation
+
+
+class lru:
+    '''
+    Bounded least-recently-used cache, shared between threads (Streamlit sessions)
+    '''
+
+    def __init__(self, maxsize=8, maxbytes=None):
+        '''
+        ### ARGUMENTS:
+        - maxsize: maximum number of entries before the least recently used one is dropped
+        - maxbytes: maximum total size of the cached arrays (None: no limit); the most recent
+                    entry is always kept, even if it is larger on its own
+        '''
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        return
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+    def get(self, key, default=None):
+        '''
+        Look up a key and mark it as recently used
+
+        ### RETURNS:
+        - cached value, or default if the key is not cached
+        '''
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+
+    def put(self, key, value):
+        '''
+        Store a value, dropping the least recently used entry if the cache is full
+        '''
+        size = nbytes(value)
+        with self._lock:
+            self.nbytes += size - self._sizes.get(key, 0)
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize or (self.maxbytes is not None and
+                                                        self.nbytes > self.maxbytes and len(self._entries) > 1):
+                dropped, _ = self._entries.popitem(last=False)
+                self.nbytes -= self._sizes.pop(dropped)
+        return
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+        return
+
+
+def nbytes(value):
+    '''
+    Memory taken by the arrays in a cached value (arrays, or tuples/lists of them)
+    '''
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(item) for item in value)
+    return getattr(value, 'nbytes', 0)
+
+
+MB = 2**20
+BLOCK_BYTES = 128 * MB      # right hand sides solved at once by smoothed_baselines
+
+baselines = lru(maxsize=8, maxbytes=512 * MB)     # (file, mtime, lambda) -> smoothed baseline
+estimates = lru(maxsize=16, maxbytes=512 * MB)    # (file, mtime, lambda) -> baseline estimated from the file itself
+masks = lru(maxsize=16, maxbytes=64 * MB)     # (file, mtime) -> points above the last estimated baseline
+factors = lru(maxsize=2, maxbytes=256 * MB)    # (length, lambda) -> Cholesky factor, 3 rows of the record length
+
+
+def sidecar_path(file, lam, kind='baseline'):
+    '''
+    Location of the on-disk copy of a smoothed baseline (not matched by the *.npy file filter)
+
+    ### ARGUMENTS:
+    - file: path to the baseline file
+    - lam: smoothness parameter
+    - kind: 'baseline' for a smoothed baseline file, 'asls' for an estimated baseline
+    '''
+    return os.path.splitext(file)[0] + '_%s_lam%g.npz' % (kind, lam)
+
+
+def _persist(path, baseline, mtime):
+    # Write a sidecar file, if possible (a read-only data folder only loses the speed-up)
+    try:
+        np.savez(path, baseline=baseline, mtime=mtime)
+    except OSError:
+        pass
+    return
+
+
+def factorisation(size, lam):
+    '''
+    Cholesky factor of I + lam*D·Dᵀ, computed once per (length, lambda)
+
+    ### RETURNS:
+    - factor to pass on to smoothing.solve
+    '''
+    key = (size, lam)
+    factor = factors.get(key)
+    if factor is None:
+        factor = smoothing.factorise(size, lam)
+        factors.put(key, factor)
+    return factor
+
+
+@instrumentation.timed
+def smoothed_baselines(files, lam, multiplier=1, persist=False, block=8):
+    '''
+    Smoothed baseline measurements, computed once per (file, mtime, lambda)
+
+    Baselines that are not cached yet are grouped by length: every group is factorised once and
+    solved as a matrix of right hand sides (block columns at a time, and no more than BLOCK_BYTES,
+    to bound the memory).
+
+    ### ARGUMENTS:
+    - files: paths to the baseline files
+    - lam: smoothness parameter
+    - multiplier: scaling of the baselines
+    - persist: also read/write a sidecar file next to every baseline file to survive app restarts
+    - block: maximum number of baselines solved at once
+
+    ### RETURNS:
+    - list of smoothed (inverted) baselines starting at t = 0, one per file
+    '''
+    mtimes = [os.path.getmtime(file) for file in files]
+    keys = [(os.path.abspath(file), mtime, lam) for file, mtime in zip(files, mtimes)]
+    results = [baselines.get(key) for key in keys]
+
+    # Baselines cached before persisting was asked for still get their sidecar file
+    for i, file in enumerate(files):
+        if results[i] is not None and persist and not os.path.exists(sidecar_path(file, lam)):
+            _persist(sidecar_path(file, lam), results[i], mtimes[i])
+
+    # Try the sidecar files
+    for i, file in enumerate(files):
+        if results[i] is None and persist:
+            try:
+                with np.load(sidecar_path(file, lam)) as sidecar:
+                    if sidecar['mtime'] == mtimes[i]:
+                        results[i] = sidecar['baseline']
+            except (OSError, KeyError, ValueError):
+                pass
+
+    # Smoothen Baseline Measurements, one factorisation per length
+    groups = {}
+    for i, file in enumerate(files):
+        if results[i] is None:
+            raw, start = calibration.load_raw(file, lazy=True)
+            groups.setdefault(len(raw) - start, []).append((i, raw, start))
+    for size, group in groups.items():
+        factor = factorisation(size, lam)
+        columns = max(1, min(block, BLOCK_BYTES // (8 * size)))
+        for first in range(0, len(group), columns):
+            chunk = group[first:first + columns]
+            y = np.empty((size, len(chunk)))
+            for j, (_, raw, start) in enumerate(chunk):
+                np.negative(raw[start:, 1], out=y[:, j])
+            z = smoothing.solve(factor, y)
+            for j, (i, _, _) in enumerate(chunk):
+                results[i] = np.ascontiguousarray(z[:, j])
+                if persist:
+                    _persist(sidecar_path(files[i], lam), results[i], mtimes[i])
+
+    for key, smoothed in zip(keys, results):
+        baselines.put(key, smoothed)
+    return [multiplier * smoothed for smoothed in results]
+
+
+def smoothed_baseline(file, lam, multiplier=1, persist=False):
+    '''
+    Smoothed baseline measurement, computed once per (file, mtime, lambda)
+
+    ### ARGUMENTS:
+    - file: path to the baseline file
+    - lam: smoothness parameter
+    - multiplier: scaling of the baseline
+    - persist: also read/write a sidecar file next to the baseline file to survive app restarts
+
+    ### RETURNS:
+    - smoothed (inverted) baseline starting at t = 0
+    '''
+    return smoothed_baselines([file], lam, multiplier, persist)[0]
+
+
+
+@instrumentation.timed
+def estimated_baseline(file, lam, multiplier=1, persist=False):
+    '''
+    Baseline estimated from a spectrum itself (asymmetric least squares), once per (file, mtime, lambda)
+
+    A new lambda starts from the points that were above the baseline for the previous one, which
+    usually halves the number of iterations.
+
+    ### ARGUMENTS:
+    - file: path to the data file
+    - lam: smoothness parameter
+    - multiplier: scaling of the baseline
+    - persist: also read/write a sidecar file next to the data file to survive app restarts
+
+    ### RETURNS:
+    - (inverted) baseline starting at t = 0
+    '''
+    mtime = os.path.getmtime(file)
+    key = (os.path.abspath(file), mtime, lam)
+    estimate = estimates.get(key)
+    path = sidecar_path(file, lam, 'asls')
+
+    # An estimate cached before persisting was asked for still gets its sidecar file
+    if estimate is not None and persist and not os.path.exists(path):
+        _persist(path, estimate, mtime)
+
+    # Try the sidecar file
+    if estimate is None and persist:
+        try:
+            with np.load(path) as sidecar:
+                if sidecar['mtime'] == mtime:
+                    estimate = sidecar['baseline']
+        except (OSError, KeyError, ValueError):
+            pass
+
+    # Estimate the baseline, warm started from the last estimate of this file
+    if estimate is None:
+        raw, start = calibration.load_raw(file, lazy=True)
+        estimate, mask = smoothing.asls(-raw[start:, 1], lam, mask=masks.get(key[:2]))
+        masks.put(key[:2], mask)
+        if persist:
+            _persist(path, estimate, mtime)
+    estimates.put(key, estimate)
+
+    return multiplier * estimate
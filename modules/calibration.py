@@ -1,10 +1,50 @@
 # Imports
+import os
 import numpy as np
-import pandas as pd
-import scipy.signal as signal
-from scipy.optimize import fsolve, minimize
-from scipy import sparse
-from scipy.sparse.linalg import spsolve
+from modules import cache
+from modules import instrumentation
+
+
+AUTOMATIC = '<automatic>'   # baseline_data that estimates the baseline from the spectrum itself
+
+
+def first_nonnegative(column):
+    '''
+    Binary search for the first non-negative entry of a monotonic column
+
+    Works on strided (memory-mapped) views without copying them, unlike np.searchsorted
+
+    ### ARGUMENTS:
+    - column: monotonically increasing array
+
+    ### RETURNS:
+    - index of the first entry >= 0
+    '''
+    low, high = 0, len(column)
+    while low < high:
+        middle = (low + high) // 2
+        if column[middle] < 0:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+@instrumentation.timed
+def load_raw(file, lazy=False):
+    '''
+    Open a (time, voltage) record and locate the trigger (t = 0)
+
+    ### ARGUMENTS:
+    - file: path to the .npy file
+    - lazy: memory-map the file instead of reading it into memory
+
+    ### RETURNS:
+    - raw: (N, 2) array of (time, voltage)
+    - start: index of the first point with t >= 0
+    '''
+    raw = np.load(file, mmap_mode='r' if lazy else None)
+    return raw, first_nonnegative(raw[:, 0])
 
 
 class load_data:
@@ -14,28 +54,87 @@ class load_data:
     Provides intuitive access to the different axes and properties (e.g. self.time instead of data[:, 0])
     '''
 
-    def __init__(self, file, init_param):
+    def __init__(self, file, init_param, lazy=False, dtype=np.float64):
         '''
         Load the data and perform a first calibration
 
         ### ARGUMENTS:
         - file: path to the data file that will be loaded
-        - lam: smoothness parameter for baseline correction
-        - 
+        - init_param: calibration parameters (G, t_off) passed on to calibrate
+        - lazy: memory-map the file and only materialise the axes that are requested
+        - dtype: floating point type of the voltage (e.g. np.float32 to halve its memory); time and
+                 mass are always float64, so neither they nor crop limits on them are quantised
         '''
 
         # Read data
         self.file = file
-        load = np.load(file)
+        self.lazy = lazy
+        self.dtype = dtype
+        self._raw, self._start = load_raw(file, lazy)
         #load = np.loadtxt(file, delimiter=',', skiprows=1, usecols=(1, 2))
-        time = load[:, 0] * 1e6    # us
-        self.voltage = -load[time>=0, 1]
-        self.time = time[time>=0]
+        self._time = None
+        self._voltage = None
+        self._mass = None
+        self.baseline = None
         self.calibrate(*init_param)
         
         return
 
 
+    def __len__(self):
+        return len(self._raw) - self._start
+
+
+    @property
+    def time(self):
+        # Time axis (us), only computed when requested
+        if self._time is None:
+            self._time = np.multiply(self._raw[self._start:, 0], 1e6, dtype=np.float64)    # us
+        return self._time
+
+    @time.setter
+    def time(self, value):
+        self._time = value
+
+
+    @property
+    def voltage(self):
+        # Inverted voltage (V), only computed when requested
+        if self._voltage is None:
+            self._voltage = np.negative(self._raw[self._start:, 1], dtype=self.dtype)
+        return self._voltage
+
+    @voltage.setter
+    def voltage(self, value):
+        self._voltage = value
+
+
+    @property
+    def mass(self):
+        # Mass axis (amu), only computed when requested
+        if self._mass is None:
+            G, t_off = self.calibration
+            self._mass = G * (self.time - t_off)**2
+        return self._mass
+
+    @mass.setter
+    def mass(self, value):
+        self._mass = value
+
+
+    def record(self):
+        '''
+        The (baseline corrected) record in the units and sign of the scope
+
+        ### RETURNS:
+        - (N, 2) array of (time (s), voltage (V)) starting at t = 0
+        '''
+        out = np.empty((len(self), 2))
+        out[:, 0] = self._raw[self._start:, 0]
+        np.negative(self.voltage, out=out[:, 1])
+        return out
+
+
     def calibrate(self, G, t_off):
         '''
         Performs a mass calibration, i.e., convert the time axis into a mass axis
@@ -44,26 +143,84 @@ class load_data:
         - G: First order coefficient of the Taylor expansion
         - t_off: Time offset <- Inability to locate the exact extraction timing
         '''
-        self.mass = G * (self.time - t_off)**2
+        self.calibration = (G, t_off)
+        self._mass = None
         return
 
     
-    def baseline_correction(self, lam=1e9, multiplier=1, baseline_data=None):
+    @instrumentation.timed
+    def baseline_correction(self, lam=1e9, multiplier=1, baseline_data=None, persist=False):
+        '''
+        Subtract a smoothed baseline measurement from the voltage
+
+        Always starts from the measured voltage, so it can be applied again with other settings
+
+        ### ARGUMENTS:
+        - lam: smoothness parameter
+        - multiplier: scaling of the baseline
+        - baseline_data: path to the baseline file, AUTOMATIC to estimate the baseline from this
+                         spectrum (asymmetric least squares), or None to remove the correction
+        - persist: keep the smoothed baseline on disk (see modules.cache)
+        '''
         # Baseline correction
-        if baseline_data != None:
-            def LSS(y, lam):
-                '''
-                Least Squares Smoothing
-                '''
-                size = len(y)
-                D = sparse.diags([1, -2, 1], [0, -1, -2], shape=(size, size-2))   # Second order difference matrix
-                D = lam * D.dot(D.transpose())
-                I = sparse.identity(size)
-                z = spsolve(I + D, y)
-                return z
-            
-            baseline = np.load(baseline_data)
-            baseline = -multiplier * baseline[time>=0, 1]
-            self.baseline = LSS(baseline, lam)  # Smoothen Baseline Measurement
-            self.voltage = self.voltage - self.baseline
-            return
\ No newline at end of file
+        if baseline_data == AUTOMATIC:
+            self.subtract_baseline(cache.estimated_baseline(self.file, lam, multiplier, persist))
+        elif baseline_data != None:
+            # Smoothen Baseline Measurement (cached per baseline file and lambda)
+            self.subtract_baseline(cache.smoothed_baseline(baseline_data, lam, multiplier, persist))
+        else:
+            self.subtract_baseline(None)
+        return
+
+
+    def subtract_baseline(self, baseline):
+        '''
+        Subtract an already smoothed and scaled baseline from the measured voltage
+
+        ### ARGUMENTS:
+        - baseline: smoothed (inverted) baseline starting at t = 0 (None removes the correction)
+
+        Raises a ValueError, and leaves the voltage as it was, if the baseline has another length
+        '''
+        if baseline is not None and len(baseline) != len(self):
+            raise ValueError('The baseline has %d points, but %s has %d'
+                             % (len(baseline), os.path.basename(str(self.file)), len(self)))
+        self._voltage = None
+        self.baseline = baseline
+        if baseline is not None:
+            self.voltage = np.subtract(self.voltage, baseline, dtype=self.dtype)
+        return
+
+
+@instrumentation.timed
+def baseline_correction(spectra, lam=1e9, multiplier=1, baseline_data=None, persist=False):
+    '''
+    Baseline correction of a number of spectra at once
+
+    Every distinct baseline file is smoothed once, and baselines of the same length share one
+    factorisation (see cache.smoothed_baselines), so a new lambda costs about the same for
+    50 spectra as for one.
+
+    ### ARGUMENTS:
+    - spectra: list of load_data
+    - lam, multiplier, persist: see load_data.baseline_correction
+    - baseline_data: path to one baseline file (or AUTOMATIC) for all spectra, or a list with a
+                     path (or AUTOMATIC or None) per spectrum
+
+    ### RETURNS:
+    - list of the spectra whose baseline has another length (left as they were)
+    '''
+    if baseline_data is None or isinstance(baseline_data, str):
+        baseline_data = [baseline_data] * len(spectra)
+    files = list(dict.fromkeys(file for file in baseline_data if file not in (None, AUTOMATIC)))
+    smoothed = dict(zip(files, cache.smoothed_baselines(files, lam, multiplier, persist)))
+    failed = []
+    for data, file in zip(spectra, baseline_data):
+        try:
+            if file == AUTOMATIC:
+                data.subtract_baseline(cache.estimated_baseline(data.file, lam, multiplier, persist))
+            else:
+                data.subtract_baseline(smoothed.get(file))
+        except ValueError:
+            failed.append(data)
+    return failed
\ No newline at end of file
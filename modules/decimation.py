@@ -0,0 +1,155 @@
+'''
+Min/max decimation of long spectra for plotting
+
+Every block of samples is reduced to its minimum and its maximum (in their original order), so
+peaks are never lost however far a trace is decimated. A pyramid keeps these envelopes at
+increasingly coarse block sizes, so any x-range can be served with about 2 points per pixel.
+'''
+
+# Imports
+import numpy as np
+
+
+def envelope(y, block, indices=None):
+    '''
+    Indices of the minimum and maximum of every block of samples
+
+    ### ARGUMENTS:
+    - y: signal
+    - block: number of samples (or indices) per block; the last block may be shorter
+    - indices: reduce only these indices of y instead of all samples (used to stack levels)
+
+    ### RETURNS:
+    - imin, imax: index arrays (into y) with one entry per block
+    '''
+    if indices is None:
+        values = y
+    else:
+        values = y[indices]
+    size = len(values)
+    full = size // block * block
+    offsets = np.arange(0, full, block)
+    blocks = values[:full].reshape(-1, block)
+    imin = blocks.argmin(axis=1) + offsets
+    imax = blocks.argmax(axis=1) + offsets
+    ## Last, partial block
+    if full < size:
+        imin = np.append(imin, full + values[full:].argmin())
+        imax = np.append(imax, full + values[full:].argmax())
+    if indices is not None:
+        imin = indices[imin]
+        imax = indices[imax]
+    return imin, imax
+
+
+def interleave(imin, imax):
+    '''
+    Merge minimum and maximum indices into one sorted index array (two points per block)
+    '''
+    out = np.empty(2 * len(imin), dtype=imin.dtype)
+    out[0::2] = np.minimum(imin, imax)
+    out[1::2] = np.maximum(imin, imax)
+    return out
+
+
+def index_range(x, x0, x1, monotonic=False):
+    '''
+    Index range of the samples with x0 <= x <= x1, including one neighbour on either side
+
+    ### ARGUMENTS:
+    - x: axis
+    - x0, x1: range
+    - monotonic: x is increasing (binary search instead of a full scan)
+
+    ### RETURNS:
+    - (start, stop) to be used as x[start:stop]
+    '''
+    if monotonic:
+        start = np.searchsorted(x, x0, side='left')
+        stop = np.searchsorted(x, x1, side='right')
+    else:
+        inside = np.flatnonzero((x >= x0) & (x <= x1))
+        if len(inside) == 0:
+            return 0, 0
+        start, stop = inside[0], inside[-1] + 1
+    return max(start - 1, 0), min(stop + 1, len(x))
+
+
+def minmax(y, start, stop, width):
+    '''
+    One-off min/max decimation of y[start:stop] to about 2*width points (e.g. for live frames)
+
+    ### RETURNS:
+    - sorted indices into y
+    '''
+    if stop - start <= 2 * width:
+        return np.arange(start, stop)
+    block = -(-(stop - start) // width)
+    imin, imax = envelope(y[start:stop], block)
+    return interleave(imin, imax) + start
+
+
+class pyramid:
+    '''
+    Multi-resolution min/max envelopes of one signal
+    '''
+
+    def __init__(self, y, base=8, factor=4, smallest=512):
+        '''
+        ### ARGUMENTS:
+        - y: signal
+        - base: block size of the finest level
+        - factor: block size ratio between consecutive levels
+        - smallest: stop adding levels once a level has fewer blocks than this
+        '''
+        self.y = y
+        self.blocks = []    # block size per level
+        self.levels = []    # (imin, imax) per level
+        dtype = np.int32 if len(y) < 2**31 else np.int64
+
+        block = base
+        imin, imax = envelope(y, base)
+        while True:
+            self.blocks.append(block)
+            self.levels.append((imin.astype(dtype), imax.astype(dtype)))
+            if len(imin) < smallest:
+                break
+            ## Next level from the previous one
+            imin, _ = envelope(y, factor, imin)
+            _, imax = envelope(y, factor, imax)
+            block *= factor
+        return
+
+
+    def query(self, start, stop, width):
+        '''
+        Indices to plot y[start:stop] with about 2*width points
+
+        ### ARGUMENTS:
+        - start, stop: index range (see index_range)
+        - width: plot width in pixels
+
+        ### RETURNS:
+        - sorted indices into y
+        '''
+        if stop - start <= 2 * width:
+            return np.arange(start, stop)
+
+        # Coarsest level with at least width blocks in the range, reduced further to about width
+        # blocks (a short range has no such level and is decimated from the samples themselves)
+        level = None
+        for i, block in enumerate(self.blocks):
+            if (stop - start) / block < width:
+                break
+            level = i
+        if level is None:
+            return minmax(self.y, start, stop, width)
+        block = self.blocks[level]
+        imin, imax = self.levels[level]
+        first, last = start // block, -(-stop // block)
+        imin, imax = imin[first:last], imax[first:last]
+        group = round(len(imin) / width)   # blocks per group, for the count nearest to width
+        if group > 1:
+            imin, _ = envelope(self.y, group, imin)
+            _, imax = envelope(self.y, group, imax)
+        return interleave(imin, imax)
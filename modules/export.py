@@ -0,0 +1,154 @@
+'''
+Export of the corrected spectra
+
+Either every spectrum goes to its own <name>_adj.npy record (time (s), voltage (V) in the sign
+of the scope, like the original files), written by a thread pool, or all spectra go to a single
+bundle with their calibration and baseline correction as metadata:
+- .npz (compressed): <name>/time (us), <name>/voltage (V), <name>/mass (amu) and a JSON
+  'metadata' entry
+- .parquet: one row per sample with the columns name, time (us), voltage (V) and mass (amu), and
+  the metadata in the schema
+Time and mass are always written in float64, the voltage in the dtype of the store.
+Unique file names are chosen from a single listing of the directory.
+'''
+
+# Imports
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from modules import instrumentation
+
+
+FORMATS = {'Files (.npy)': 'npy',
+           'Bundle (.npz)': 'npz',
+           'Bundle (.parquet)': 'parquet'}
+
+
+def unique_names(directory, stems, extension):
+    '''
+    Unused file names <stem><extension>, <stem>_0<extension>, ... for a number of stems
+
+    ### ARGUMENTS:
+    - directory: output directory (listed once)
+    - stems: file names without extension
+    - extension: e.g. '.npy'
+
+    ### RETURNS:
+    - list of file names, one per stem
+    '''
+    taken = set(os.listdir(directory))
+    names = []
+    for stem in stems:
+        name = stem + extension
+        i = 0
+        while name in taken:
+            name = '%s_%d%s' % (stem, i, extension)
+            i += 1
+        taken.add(name)
+        names.append(name)
+    return names
+
+
+def metadata(store):
+    '''
+    Calibration and baseline correction of the spectra in a store, as a JSON string
+    '''
+    a, k = store.calibration if store.calibration is not None else (None, None)
+    baselines = {}
+    for name in store.spectra:
+        file, lam, multiplier = store.baselines.get(name, (None, None, None))
+        baselines[name] = None if file is None else {'file': file, 'lam': lam, 'multiplier': multiplier}
+    return json.dumps({'calibration': {'a': a, 'k': k, 'formula': 'm = a(t-k)^2'},
+                       'baseline': baselines,
+                       'units': {'time': 'us', 'voltage': 'V (inverted)', 'mass': 'amu'}})
+
+
+def write_record(path, data):
+    # The record of one spectrum in the units and sign of the scope
+    np.save(path, data.record())
+    return path
+
+
+def export_files(store, names, directory, suffix='_adj', workers=4):
+    '''
+    Write every spectrum to its own record, in parallel
+
+    ### ARGUMENTS:
+    - store: spectrum_store
+    - names: spectra to export
+    - directory: output directory
+    - suffix: appended to the name of every spectrum
+    - workers: number of writing threads
+
+    ### RETURNS:
+    - list of written paths
+    '''
+    names = [name for name in names if name in store]
+    files = unique_names(directory, [os.path.splitext(name)[0] + suffix for name in names], '.npy')
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(write_record, os.path.join(directory, file), store[name])
+                   for name, file in zip(names, files)]
+        return [future.result() for future in futures]
+
+
+def export_npz(path, store, names):
+    '''
+    Write a number of spectra and their metadata to one compressed .npz bundle
+    '''
+    arrays = {'metadata': np.array(metadata(store))}
+    for name in names:
+        if name not in store:
+            continue
+        data = store[name]
+        arrays[name + '/time'] = np.asarray(data.time, dtype=np.float64)
+        arrays[name + '/voltage'] = data.voltage
+        arrays[name + '/mass'] = np.asarray(data.mass, dtype=np.float64)
+    np.savez_compressed(path, **arrays)
+    return path
+
+
+def export_parquet(path, store, names):
+    '''
+    Write a number of spectra and their metadata to one .parquet bundle
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    names = [name for name in names if name in store]
+    lengths = [len(store[name]) for name in names]
+    # The name column is dictionary encoded: one small integer per sample
+    codes = np.repeat(np.arange(len(names), dtype=np.int32), lengths)
+    table = pa.table({'name': pa.DictionaryArray.from_arrays(codes, pa.array(names)),
+                      'time': np.concatenate([np.asarray(store[name].time, dtype=np.float64) for name in names]),
+                      'voltage': np.concatenate([store[name].voltage for name in names]),
+                      'mass': np.concatenate([np.asarray(store[name].mass, dtype=np.float64) for name in names])},
+                     metadata={'fcs': metadata(store)})
+    pq.write_table(table, path)
+    return path
+
+
+@instrumentation.timed
+def export(store, names, directory, format='npy', stem='spectra'):
+    '''
+    Export a number of spectra in one of the FORMATS
+
+    ### ARGUMENTS:
+    - store: spectrum_store
+    - names: spectra to export
+    - directory: output directory
+    - format: 'npy' (one record per spectrum), 'npz' or 'parquet' (one bundle)
+    - stem: file name of a bundle (without extension)
+
+    ### RETURNS:
+    - list of written paths
+    '''
+    if format == 'npy':
+        return export_files(store, names, directory)
+    elif format == 'npz':
+        file, = unique_names(directory, [stem], '.npz')
+        return [export_npz(os.path.join(directory, file), store, names)]
+    elif format == 'parquet':
+        file, = unique_names(directory, [stem], '.parquet')
+        return [export_parquet(os.path.join(directory, file), store, names)]
+    raise ValueError("format should be 'npy', 'npz' or 'parquet'")
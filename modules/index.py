@@ -0,0 +1,190 @@
+'''
+Index of the data files in a directory
+
+The directory is scanned once; afterwards only the directory's modification time is polled and
+only new or changed files are opened. Per file the point count, time step, time range and
+acquisition date are kept, also in a small on-disk index next to the data, so widgets never
+have to touch the data (or re-list a network mount) on a rerun.
+'''
+
+# Imports
+import os
+import json
+import threading
+from datetime import datetime
+import numpy as np
+from modules import instrumentation
+from modules.recording import SIDECARS
+
+
+INDEX_FILE = '.fcs_index.json'
+VERSION = 1
+
+
+def read_metadata(path, stat):
+    '''
+    Metadata of a (time, voltage) record, reading only its header and a few rows
+
+    ### ARGUMENTS:
+    - path: path to the .npy file
+    - stat: os.stat_result of the file
+
+    ### RETURNS:
+    - dictionary of metadata, or None if the file is not a (time, voltage) record
+    '''
+    try:
+        raw = np.load(path, mmap_mode='r')
+    except (OSError, ValueError, EOFError):
+        return None
+    if raw.ndim != 2 or raw.shape[1] < 2 or raw.shape[0] < 2:
+        return None
+    return {'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'points': int(raw.shape[0]),
+            'dt': float(raw[1, 0] - raw[0, 0]),     # s
+            't_start': float(raw[0, 0]),            # s
+            't_stop': float(raw[-1, 0]),            # s
+            'acquired': datetime.fromtimestamp(stat.st_mtime).isoformat(timespec='seconds')}
+
+
+class directory_index:
+    '''
+    Incrementally updated index of the *.npy records in one directory
+    '''
+
+    def __init__(self, directory, extension='.npy', persist=True):
+        '''
+        ### ARGUMENTS:
+        - directory: data directory
+        - extension: file extension of the records
+        - persist: keep the index in the directory as well (ignored if it is not writable)
+        '''
+        self.directory = directory
+        self.extension = extension
+        self.persist = persist
+        self.files = {}     # name -> metadata
+        self._mtime = None  # modification time of the directory at the last scan
+        self._lock = threading.Lock()
+        self._load()
+        return
+
+
+    def __contains__(self, name):
+        return name in self.files
+
+
+    def __getitem__(self, name):
+        return self.files[name]
+
+
+    def names(self):
+        '''
+        Sorted file names
+        '''
+        return sorted(self.files)
+
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+
+    @instrumentation.timed
+    def refresh(self, force=False):
+        '''
+        Update the index if the directory changed
+
+        ### ARGUMENTS:
+        - force: rescan even if the directory itself did not change (e.g. files rewritten in place)
+
+        ### RETURNS:
+        - True if the index changed
+        '''
+        with self._lock:
+            try:
+                mtime = os.stat(self.directory).st_mtime
+            except OSError:
+                changed = len(self.files) > 0
+                self.files = {}
+                self._mtime = None
+                return changed
+            if not force and mtime == self._mtime:
+                return False
+
+            # Only open new or modified files
+            changed = False
+            found = {}
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(self.extension) or not entry.is_file():
+                        continue
+                    if entry.name[:-len(self.extension)].endswith(SIDECARS):
+                        continue    # frames and timestamps of a recording
+                    stat = entry.stat()
+                    known = self.files.get(entry.name)
+                    if known is not None and known['mtime'] == stat.st_mtime and known['size'] == stat.st_size:
+                        found[entry.name] = known
+                        continue
+                    metadata = read_metadata(entry.path, stat)
+                    if metadata is not None:
+                        found[entry.name] = metadata
+                    changed = True
+            changed = changed or found.keys() != self.files.keys()
+            self.files = found
+            self._mtime = mtime
+            if changed and self._dump():
+                # Writing the on-disk index changed the directory itself: do not rescan for that
+                try:
+                    self._mtime = os.stat(self.directory).st_mtime
+                except OSError:
+                    pass
+            return changed
+
+
+    def _load(self):
+        # Read the on-disk index (entries are validated against the files on the next refresh)
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE), 'r') as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return
+        if stored.get('version') == VERSION:
+            self.files = stored.get('files', {})
+        return
+
+
+    def _dump(self):
+        # Write the on-disk index atomically, returns whether it was written
+        if not self.persist:
+            return False
+        location = os.path.join(self.directory, INDEX_FILE)
+        try:
+            with open(location + '.tmp', 'w') as f:
+                json.dump({'version': VERSION, 'files': self.files}, f)
+            os.replace(location + '.tmp', location)
+        except OSError:
+            return False
+        return True
+
+
+_indices = {}
+_indices_lock = threading.Lock()
+
+
+def get_index(directory, force=False):
+    '''
+    Shared, refreshed index of a directory (built on first use)
+
+    ### ARGUMENTS:
+    - directory: data directory
+    - force: rescan all files
+
+    ### RETURNS:
+    - directory_index
+    '''
+    key = os.path.abspath(directory)
+    with _indices_lock:
+        if key not in _indices:
+            _indices[key] = directory_index(directory)
+        index = _indices[key]
+    index.refresh(force)
+    return index
@@ -0,0 +1,309 @@
+'''
+Lightweight timing (and memory) instrumentation of the reruns of the pages
+
+Hot functions are wrapped with timed and page code is wrapped in span blocks. While profiling is
+off (the default) a span is a shared no-op context and a timed function costs one extra check,
+so the instrumentation can stay in place. Profiling is switched on per thread, i.e. per
+Streamlit session, for one rerun at a time (begin ... end). Every span records its name, its
+nesting depth, its wall time and, if memory tracing is on, the peak of the memory traced by
+tracemalloc while it ran. tracemalloc is process wide, so concurrent sessions share the peak, and
+it runs while at least one session asks for it.
+
+Streamlit runs callbacks (on_click, ...) before the script of the page, i.e. before begin: wrapped
+with callback, their spans are kept in the session state and added to the next rerun.
+
+The spans of a rerun can be shown in the sidebar (panel) and appended to a JSONL log (append)
+to compare runs offline, e.g. before and after an upgrade.
+'''
+
+# Imports
+import json
+import time
+import threading
+import uuid
+import functools
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+
+MAX_SPANS = 2000    # per rerun, e.g. for the endless loop of the Live Feed
+
+_state = threading.local()
+_off = nullcontext()
+
+_tracers = set()    # owners (sessions) that asked for memory tracing
+_tracers_lock = threading.Lock()
+_tracing = False    # whether tracemalloc was started here (and not by someone else)
+
+
+def enabled():
+    return getattr(_state, 'enabled', False)
+
+
+def trace_memory(owner, on):
+    '''
+    Ask for memory tracing, or give it up
+
+    tracemalloc is started when the first owner asks for it and only stopped when the last one
+    gives it up (and only if it was started here).
+
+    ### ARGUMENTS:
+    - owner: anything hashable identifying who asks, e.g. a session
+    - on: whether this owner wants memory tracing
+    '''
+    global _tracing
+    with _tracers_lock:
+        if on:
+            _tracers.add(owner)
+        else:
+            _tracers.discard(owner)
+        if len(_tracers) > 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracing = True
+        elif len(_tracers) == 0 and _tracing:
+            tracemalloc.stop()
+            _tracing = False
+    return
+
+
+def begin(page, enable=True, memory=None, owner=None, records=None):
+    '''
+    Start collecting the spans of a rerun in this thread
+
+    ### ARGUMENTS:
+    - page: name of the page, stored with the spans
+    - enable: collect spans (False makes every span a no-op)
+    - memory: True also traces the peak memory of every span (slows down all allocations), False
+              gives up tracing, None leaves it as it is (e.g. in a background thread)
+    - owner: who asks for memory tracing (see trace_memory), e.g. the session
+    - records: spans collected before the rerun started (e.g. of callbacks)
+    '''
+    if memory is not None and owner is not None:
+        trace_memory(owner, bool(enable and memory))
+    _state.enabled = enable
+    _state.page = page
+    _state.memory = bool(enable and memory) and tracemalloc.is_tracing()
+    _state.records = list(records) if records is not None else []
+    _state.stack = []
+    # Time spent in those spans counts towards the rerun
+    _state.before = sum(record['seconds'] for record in _state.records if record['depth'] == 1)
+    _state.started = time.perf_counter()
+    return
+
+
+def end():
+    '''
+    Stop collecting spans in this thread
+
+    ### RETURNS:
+    - list of span records of the rerun, in the order they finished, the last one being the whole
+      rerun (named after the page)
+    '''
+    records = getattr(_state, 'records', [])
+    if enabled():
+        records.append({'name': _state.page, 'depth': 0,
+                        'seconds': time.perf_counter() - _state.started + _state.before, 'peak_mb': None})
+    _state.enabled = False
+    _state.records = []
+    return records
+
+
+def records():
+    '''
+    Spans collected so far in this thread (without ending the rerun)
+    '''
+    return list(getattr(_state, 'records', []))
+
+
+@contextmanager
+def _span(name):
+    stack = _state.stack
+    if _state.memory:
+        # Keep the peak of the enclosing span before resetting it for this one
+        if len(stack) > 0:
+            stack[-1][1] = max(stack[-1][1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    entry = [name, 0]
+    stack.append(entry)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        stack.pop()
+        peak = None
+        if _state.memory:
+            peak = max(entry[1], tracemalloc.get_traced_memory()[1])
+            if len(stack) > 0:
+                stack[-1][1] = max(stack[-1][1], peak)
+            peak /= 2**20
+        if len(_state.records) < MAX_SPANS:
+            _state.records.append({'name': name, 'depth': len(stack) + 1, 'seconds': seconds, 'peak_mb': peak})
+
+
+def span(name):
+    '''
+    Time a block of code: with span('figure'): ...
+    '''
+    if not enabled():
+        return _off
+    return _span(name)
+
+
+def timed(function=None, name=None):
+    '''
+    Decorator that times every call of a function (as a span named after the function)
+    '''
+    if function is None:
+        return functools.partial(timed, name=name)
+    label = name if name is not None else function.__module__.split('.')[-1] + '.' + function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not getattr(_state, 'enabled', False):
+            return function(*args, **kwargs)
+        with _span(label):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def instrument(module, names):
+    '''
+    Time functions of a module that cannot be edited (e.g. johanpackage), by replacing them in place
+
+    Only calls through the module (module.function) are timed. Instrumenting twice is harmless.
+
+    ### ARGUMENTS:
+    - module: the module
+    - names: names of its functions
+    '''
+    for name in names:
+        function = getattr(module, name)
+        if not getattr(function, '_instrumented', False):
+            wrapper = timed(function, name=module.__name__.split('.')[-1] + '.' + name)
+            wrapper._instrumented = True
+            setattr(module, name, wrapper)
+    return
+
+
+def _session():
+    # Profiling settings of the Streamlit session, and a token identifying it
+    import streamlit as st
+
+    if 'profile_owner' not in st.session_state:
+        st.session_state['profile_owner'] = uuid.uuid4().hex
+    return st.session_state
+
+
+def begin_rerun(page):
+    '''
+    Start collecting the spans of a rerun of a page, with the switches of the panel
+
+    The spans of the callbacks that ran before it (see callback) are part of the rerun.
+
+    ### RETURNS:
+    - whether profiling is on
+    '''
+    state = _session()
+    enable = state.get('profile', False)
+    begin(page, enable, state.get('profile_memory', False), owner=state['profile_owner'],
+          records=state.pop('profile_callbacks', []))
+    return enable
+
+
+def callback(function=None, name=None):
+    '''
+    Decorator that times a Streamlit callback (on_click, on_change, ...)
+
+    Callbacks run before the script of the page, so outside a rerun their spans are kept in the
+    session state until begin_rerun picks them up. Called from the script itself, the function
+    is timed like any other.
+    '''
+    if function is None:
+        return functools.partial(callback, name=name)
+    label = name if name is not None else function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if enabled():
+            with _span(label):
+                return function(*args, **kwargs)
+        state = _session()
+        if not state.get('profile', False):
+            return function(*args, **kwargs)
+        begin(label, True, state.get('profile_memory', False), owner=state['profile_owner'])
+        try:
+            with _span(label):
+                return function(*args, **kwargs)
+        finally:
+            state['profile_callbacks'] = state.get('profile_callbacks', []) + _state.records
+            _state.enabled = False
+            _state.records = []
+    return wrapper
+
+
+def summary(records):
+    '''
+    Total time, number of calls and peak memory per span name
+
+    ### RETURNS:
+    - dictionary of columns (name, calls, seconds, peak_mb), slowest first
+    '''
+    totals = {}
+    for record in records:
+        calls, seconds, peak = totals.get(record['name'], (0, 0., None))
+        if record['peak_mb'] is not None:
+            peak = record['peak_mb'] if peak is None else max(peak, record['peak_mb'])
+        totals[record['name']] = (calls + 1, seconds + record['seconds'], peak)
+    names = sorted(totals, key=lambda name: -totals[name][1])
+    return {'name': names,
+            'calls': [totals[name][0] for name in names],
+            'seconds': [totals[name][1] for name in names],
+            'peak_mb': [totals[name][2] for name in names]}
+
+
+def append(path, page, records, **info):
+    '''
+    Append the spans of a rerun as one line to a JSONL log
+
+    ### ARGUMENTS:
+    - path: log file
+    - page: name of the page
+    - records: span records (see end)
+    - info: anything else worth keeping with them (e.g. the number of selected files)
+    '''
+    line = {'time': datetime.now().isoformat(timespec='seconds'), 'page': page, 'spans': records}
+    line.update(info)
+    with open(path, 'a') as f:
+        f.write(json.dumps(line) + '\n')
+    return
+
+
+def panel(page, records, log='profile.jsonl'):
+    '''
+    Sidebar panel with the spans of the last rerun of a page and the profiling switches
+
+    The switches take effect from the next rerun.
+
+    ### ARGUMENTS:
+    - page: name of the page
+    - records: span records of the last rerun
+    - log: default JSONL log file
+    '''
+    import streamlit as st
+
+    with st.sidebar:
+        with st.expander('Performance'):
+            st.toggle('Profile reruns', key='profile')
+            st.toggle('Trace memory', key='profile_memory', help='Peak memory per span (slows the app down)')
+            st.text_input('Log file', value=log, key='profile_log')
+            logging = st.toggle('Append to log', key='profile_append')
+            if len(records) > 0:
+                st.dataframe(summary(records), hide_index=True, use_container_width=True)
+                if logging:
+                    try:
+                        append(st.session_state['profile_log'], page, records)
+                    except OSError as error:
+                        st.warning(f'Could not write the log: {error}')
+    return
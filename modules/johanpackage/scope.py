@@ -5,13 +5,166 @@ Functions to control the MDO34 Scope
 import pyvisa
 import numpy as np
 import configparser
+import threading
 from struct import unpack 
 
 configfn = "channelassignments.ini"
 configchn = configparser.ConfigParser()
 configchn.read(configfn)
-rm = pyvisa.ResourceManager()
-res = rm.list_resources()
+
+
+# NOT WRITTEN BY JOHAN BUT BY THE FCS-VISUALISER MAINTAINERS
+# Instrument discovery is deferred until a scope is actually used (instead of at import), runs
+# with a timeout, and is cached together with the *IDN? answer of every port. rm and res below
+# stand in for the ResourceManager and the resource list, so Johan's functions below are unchanged.
+DISCOVERY_TIMEOUT = 10  # s, maximum time to wait for the VISA resources to be listed
+
+_discovery_lock = threading.Lock()
+_manager = None
+_resources = None   # cached list_resources()
+_listing = None     # thread listing the resources
+_listing_error = None   # why the last listing failed
+_identities = {}    # resource name -> *IDN? answer
+
+
+def resource_manager():
+    '''
+    The VISA resource manager, created on first use
+
+    Loading the VISA backend can hang, so the lock is not held meanwhile (see resources).
+
+    ### RETURNS:
+    - pyvisa.ResourceManager
+    '''
+    global _manager
+    if _manager is None:
+        manager = pyvisa.ResourceManager()
+        with _discovery_lock:
+            if _manager is None:
+                _manager = manager
+    return _manager
+
+
+def resources(timeout=DISCOVERY_TIMEOUT, refresh=False):
+    '''
+    The VISA resources, listed once (in a background thread, so a flaky backend or device cannot hang the app)
+
+    The resource manager is created in the same thread, so loading the VISA backend is bounded by
+    the timeout as well.
+
+    ### ARGUMENTS:
+    - timeout: maximum time to wait for the listing (s)
+    - refresh: list the resources again (e.g. after plugging in a scope); forgets the identities
+
+    ### RETURNS:
+    - tuple of resource names
+    '''
+    global _resources, _listing, _listing_error
+    with _discovery_lock:
+        if refresh:
+            _resources = None
+            _identities.clear()
+        if _resources is not None:
+            return _resources
+        if _listing is None or not _listing.is_alive():
+            def listing():
+                global _resources, _listing_error
+                try:
+                    found = tuple(resource_manager().list_resources())
+                except Exception as error:     # e.g. no VISA backend installed
+                    with _discovery_lock:
+                        _listing_error = error
+                    return
+                with _discovery_lock:
+                    _resources = found
+            _listing_error = None
+            _listing = threading.Thread(target=listing, name='visa discovery', daemon=True)
+            _listing.start()
+        thread = _listing
+    # A listing that times out keeps running and is picked up by the next call
+    thread.join(timeout)
+    with _discovery_lock:
+        if _resources is None and _listing_error is not None:
+            raise _listing_error
+        if _resources is None:
+            raise TimeoutError("Listing the VISA resources took longer than " + str(timeout) + " s")
+        return _resources
+
+
+def use_resource_manager(manager):
+    '''
+    Serve the resources of another resource manager, e.g. modules.simulator.simulated_resource_manager
+
+    ### ARGUMENTS:
+    - manager: object with list_resources() and open_resource(name)
+    '''
+    global _manager, _resources
+    with _discovery_lock:
+        if manager is not _manager:
+            _manager = manager
+            _resources = None
+            _identities.clear()
+    return
+
+
+class _identified_resource:
+    '''
+    An opened resource whose *IDN? answer is cached per resource name
+    '''
+
+    def __init__(self, name, resource):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_resource', resource)
+
+    def query(self, message, *args, **kwargs):
+        if message.strip().upper() == '*IDN?':
+            if self._name not in _identities:
+                _identities[self._name] = self._resource.query(message, *args, **kwargs)
+            return _identities[self._name]
+        return self._resource.query(message, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._resource, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resource, name, value)
+
+
+class _lazy_manager:
+    '''
+    Stands in for the ResourceManager: created on first use, opened resources remember their *IDN?
+    '''
+
+    def open_resource(self, name, *args, **kwargs):
+        return _identified_resource(name, resource_manager().open_resource(name, *args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(resource_manager(), name)
+
+
+class _lazy_resources:
+    '''
+    Stands in for the resource list: listed on first use
+    '''
+
+    def __iter__(self):
+        return iter(resources())
+
+    def __len__(self):
+        return len(resources())
+
+    def __getitem__(self, index):
+        return resources()[index]
+
+    def __contains__(self, name):
+        return name in resources()
+
+    def __repr__(self):
+        return repr(resources())
+
+
+rm = _lazy_manager()
+res = _lazy_resources()
 
 def findport_scope(portnu, snnu):
     '''
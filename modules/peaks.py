@@ -0,0 +1,170 @@
+'''
+Peak table of the loaded spectra
+
+All peaks of a spectrum are detected at once (scipy.signal.find_peaks) and their width, centroid
+and area follow from cumulative sums over the signal, interpolated at the (fractional) peak
+boundaries, so there is no Python loop over the peaks. Centroids are converted to mass with the
+current calibration.
+
+Results are cached per (file, calibration, baseline correction, detection settings), so only
+files that are new or changed are analysed again. When many files need analysing, they are
+spread over a pool of worker processes.
+'''
+
+# Imports
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from modules import cache
+from modules.calibration import load_data, AUTOMATIC
+from modules import instrumentation
+
+
+COLUMNS = ['file', 'mass', 'time', 'height', 'fwhm', 'area']
+PARALLEL_FILES = 4      # analyse in worker processes from this many files on
+
+tables = cache.lru(maxsize=256)     # (file, mtime, settings) -> peaks of one file
+_executors = {}     # number of processes -> pool, shared by all sessions
+_executors_lock = threading.Lock()
+
+
+def interpolate(cumulative, positions):
+    '''
+    Value of a cumulative sum at fractional sample positions
+    '''
+    return np.interp(positions, np.arange(len(cumulative)), cumulative)
+
+
+def detect(time, voltage, calibration, prominence=0.01, rel_height=0.95):
+    '''
+    Detect, centroid and integrate all peaks of a spectrum
+
+    ### ARGUMENTS:
+    - time: time axis (us)
+    - voltage: baseline corrected, inverted voltage (V)
+    - calibration: (a, k) of the mass calibration m = a(t-k)^2
+    - prominence: minimum peak prominence (V)
+    - rel_height: the peak area and centroid are taken over the part of the peak above this
+                  fraction of its prominence (measured from the top), i.e. above the local pedestal
+
+    ### RETURNS:
+    - dictionary of arrays with the mass (amu) and time (us) of the centroid, the height (V),
+      the full width at half maximum (us) and the area (V us) of every peak
+    '''
+    from scipy.signal import find_peaks, peak_widths    # only when peaks are asked for (app startup)
+    time = np.asarray(time, dtype=np.float64)
+    voltage = np.asarray(voltage, dtype=np.float64)
+    peaks, _ = find_peaks(voltage, prominence=prominence)
+    if len(peaks) == 0:
+        empty = np.empty(0)
+        return {'mass': empty, 'time': empty, 'height': empty, 'fwhm': empty, 'area': empty}
+
+    positions = np.arange(len(time))
+    # Full width at half maximum
+    _, _, left, right = peak_widths(voltage, peaks, rel_height=0.5)
+    fwhm = np.interp(right, positions, time) - np.interp(left, positions, time)
+    # Area and centroid above the level at rel_height, between its crossings (trapezoidal cumulative sums)
+    _, level, left, right = peak_widths(voltage, peaks, rel_height=rel_height)
+    dt = np.diff(time)
+    area = np.concatenate(([0.], np.cumsum(0.5 * (voltage[1:] + voltage[:-1]) * dt)))
+    moment = time * voltage
+    moment = np.concatenate(([0.], np.cumsum(0.5 * (moment[1:] + moment[:-1]) * dt)))
+    t_left, t_right = np.interp(left, positions, time), np.interp(right, positions, time)
+    areas = interpolate(area, right) - interpolate(area, left) - level * (t_right - t_left)
+    moments = interpolate(moment, right) - interpolate(moment, left) - level * (t_right**2 - t_left**2) / 2
+    centroid = np.where(areas > 0, moments / np.where(areas > 0, areas, 1), time[peaks])
+
+    a, k = calibration
+    return {'mass': a * (centroid - k)**2,
+            'time': centroid,
+            'height': voltage[peaks],
+            'fwhm': fwhm,
+            'area': areas}
+
+
+def file_peaks(path, calibration, baseline=None, prominence=0.01, rel_height=0.95):
+    '''
+    Peaks of one data file (also runs in a worker process)
+
+    ### ARGUMENTS:
+    - path: path to the data file
+    - calibration: (a, k) of the mass calibration
+    - baseline: (baseline file or AUTOMATIC, lambda, multiplier) of the baseline correction, or
+                None; the baseline is smoothed (or estimated) through the caches of the process
+                that runs this, so a worker only smooths a baseline file once
+    - prominence, rel_height: see detect
+
+    ### RETURNS:
+    - dictionary of arrays, see detect
+    '''
+    data = load_data(path, calibration, lazy=True)
+    voltage = data.voltage
+    if baseline is not None and baseline[0] == AUTOMATIC:
+        _, lam, multiplier = baseline
+        voltage = voltage - cache.estimated_baseline(path, lam, multiplier)
+    elif baseline is not None:
+        voltage = voltage - cache.smoothed_baseline(*baseline)
+    return detect(data.time, voltage, calibration, prominence, rel_height)
+
+
+def _executor(processes):
+    # One long-lived pool per size; never shut down while another session may be submitting to it
+    with _executors_lock:
+        if processes not in _executors:
+            _executors[processes] = ProcessPoolExecutor(processes)
+        return _executors[processes]
+
+
+def _compute(paths, calibration, baseline, prominence, rel_height, processes):
+    # Analyse the files in this process, or in a pool when there are many. Only the baseline
+    # settings travel with a task, never the baseline itself.
+    if len(paths) < PARALLEL_FILES or processes == 1:
+        return [file_peaks(path, calibration, baseline, prominence, rel_height) for path in paths]
+    executor = _executor(processes)
+    futures = [executor.submit(file_peaks, path, calibration, baseline, prominence, rel_height) for path in paths]
+    return [future.result() for future in futures]
+
+
+@instrumentation.timed
+def peak_table(files, calibration, baseline=None, prominence=0.01, rel_height=0.95, processes=None):
+    '''
+    Mass-assigned peak table of a number of data files
+
+    ### ARGUMENTS:
+    - files: dictionary of name -> path
+    - calibration: (a, k) of the mass calibration
+    - baseline: (baseline file or AUTOMATIC, lambda, multiplier) of the baseline correction, or None
+    - prominence, rel_height: see detect
+    - processes: maximum number of worker processes (None: number of CPUs, 1: no pool)
+
+    ### RETURNS:
+    - DataFrame with one row per peak and the columns file, mass (amu), time (us), height (V),
+      fwhm (us) and area (V us)
+    '''
+    calibration = tuple(calibration)
+    settings = (calibration, prominence, rel_height)
+    if baseline is not None and baseline[0] == AUTOMATIC:
+        settings += baseline
+    elif baseline is not None and baseline[0] is not None:
+        baseline_file, lam, multiplier = baseline
+        settings += (os.path.abspath(baseline_file), os.path.getmtime(baseline_file), lam, multiplier)
+    else:
+        baseline = None
+
+    # Only analyse files that are not cached yet
+    keys = {name: (os.path.abspath(path), os.path.getmtime(path)) + settings for name, path in files.items()}
+    results = {name: tables.get(key) for name, key in keys.items()}
+    missing = [name for name, result in results.items() if result is None]
+    if len(missing) > 0:
+        computed = _compute([files[name] for name in missing], calibration, baseline, prominence, rel_height, processes)
+        for name, result in zip(missing, computed):
+            tables.put(keys[name], result)
+            results[name] = result
+
+    # Assemble the table
+    frames = [pd.DataFrame(result).assign(file=name) for name, result in results.items()]
+    if len(frames) == 0:
+        return pd.DataFrame(columns=COLUMNS)
+    return pd.concat(frames, ignore_index=True)[COLUMNS]
@@ -0,0 +1,113 @@
+'''
+Rebinning of spectra onto a shared, uniform mass grid
+
+The mass axis m = a(t-k)^2 of every spectrum is non-uniform, so spectra of different runs can
+only be compared by eye. Here every sample (after t = k) is added to the mass bin it falls in,
+which conserves the accumulated voltage. Because the mass axis increases monotonically, the
+samples of a bin are contiguous: the first sample of every bin is found once with a binary search
+and kept per (time axis, a, k, grid), after which a spectrum is rebinned with a single
+np.add.reduceat. Sums, averages and differences of many runs are then plain array arithmetic.
+'''
+
+# Imports
+import numpy as np
+from modules import cache
+from modules import instrumentation
+
+
+maps = cache.lru(maxsize=32)     # (time axis, a, k, grid) -> bin map
+
+
+def grid(start, stop, step):
+    '''
+    Edges of a uniform mass grid
+
+    ### ARGUMENTS:
+    - start, stop: mass range (amu), stop is rounded up to a whole bin
+    - step: bin width (amu)
+
+    ### RETURNS:
+    - array of bin edges
+    '''
+    bins = max(int(np.ceil((stop - start) / step)), 1)
+    return start + step * np.arange(bins + 1)
+
+
+def centres(edges):
+    return (edges[:-1] + edges[1:]) / 2
+
+
+def bin_map(time, a, k, edges):
+    '''
+    First sample of every mass bin, cached per (time axis, a, k, grid)
+
+    Time axes are identified by their length and end points: records of the same scope settings
+    share one map.
+
+    ### ARGUMENTS:
+    - time: increasing time axis (us)
+    - a, k: mass calibration m = a(t-k)^2
+    - edges: increasing bin edges (amu)
+
+    ### RETURNS:
+    - starts: first sample of every bin that holds samples
+    - filled: boolean mask of the bins that hold samples
+    - stop: one past the last sample inside the grid
+    '''
+    key = (len(time), float(time[0]), float(time[-1]), float(a), float(k),
+           float(edges[0]), float(edges[-1]), len(edges))
+    result = maps.get(key)
+    if result is None:
+        # Before k the mass decreases with time: those samples are left out
+        first = int(np.searchsorted(time, k, side='right'))
+        mass = a * (np.asarray(time[first:], dtype=np.float64) - k)**2
+        bounds = first + np.searchsorted(mass, edges)
+        filled = np.diff(bounds) > 0
+        result = (bounds[:-1][filled], filled, int(bounds[-1]))
+        maps.put(key, result)
+    return result
+
+
+def rebin(data, edges):
+    '''
+    Project a spectrum onto a mass grid, conserving the accumulated voltage
+
+    ### ARGUMENTS:
+    - data: load_data (with its calibration and baseline correction applied)
+    - edges: increasing bin edges (amu)
+
+    ### RETURNS:
+    - sum of the voltage (V) of the samples in every bin (0 for bins without samples)
+    '''
+    starts, filled, stop = bin_map(data.time, *data.calibration, edges)
+    out = np.zeros(len(edges) - 1)
+    if len(starts) > 0:
+        out[filled] = np.add.reduceat(data.voltage[:stop], starts, dtype=np.float64)
+    return out
+
+
+@instrumentation.timed
+def combine(spectra, edges, how='sum'):
+    '''
+    Sum, average or difference of a number of spectra on a shared mass grid
+
+    ### ARGUMENTS:
+    - spectra: list of load_data
+    - edges: increasing bin edges (amu)
+    - how: 'sum', 'mean' or 'difference' (the first spectrum minus the mean of the others)
+
+    ### RETURNS:
+    - combined voltage (V) per bin
+    '''
+    if len(spectra) == 0:
+        return np.zeros(len(edges) - 1)
+    rebinned = np.stack([rebin(data, edges) for data in spectra])
+    if how == 'sum':
+        return rebinned.sum(axis=0)
+    elif how == 'mean':
+        return rebinned.mean(axis=0)
+    elif how == 'difference':
+        if len(spectra) == 1:
+            return rebinned[0]
+        return rebinned[0] - rebinned[1:].mean(axis=0)
+    raise ValueError("how should be 'sum', 'mean' or 'difference'")
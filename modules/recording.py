@@ -0,0 +1,241 @@
+'''
+Streaming capture of live frames to disk
+
+A recording consists of three .npy files:
+- <name>.npy: a normal float64 (time (s), mean voltage of all recorded frames (V)) record, so a
+  recording opens in the visualiser like any other file, with the full time resolution
+- <name>_frames.npy: the individual frames (V), one per column, in Fortran (column) order, so
+  every frame is one contiguous, append-only block at the end of the file; they can be
+  memory-mapped with np.load(path, mmap_mode='r')
+- <name>_timestamps.npy: the acquisition time of every frame
+
+The files are preallocated in chunks and their headers are rewritten after every frame, so they stay
+readable while they grow (and after a crash). Frames are copied into a bounded pool of buffers and
+written by a background thread; if the disk cannot keep up, frames are dropped (and counted)
+instead of stalling the acquisition.
+'''
+
+# Imports
+import os
+import time
+import queue
+import struct
+import threading
+import numpy as np
+
+
+HEADER_SIZE = 128   # bytes, fixed so the header can be rewritten in place
+
+
+def write_header(f, shape, dtype):
+    '''
+    Write a (version 1.0) .npy header for a Fortran ordered array of the given shape
+
+    ### ARGUMENTS:
+    - f: file opened for binary writing
+    - shape: shape of the array
+    - dtype: data type of the array
+    '''
+    header = repr({'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': True, 'shape': tuple(shape)})
+    header = header.ljust(HEADER_SIZE - 11) + '\n'
+    f.seek(0)
+    f.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
+    return
+
+
+SIDECARS = ('_frames', '_timestamps')   # suffixes of the files next to a recording
+
+
+class column_file:
+    '''
+    Append-only .npy file of equally long columns, preallocated in chunks
+    '''
+
+    def __init__(self, path, rows=None, dtype=np.float32, chunk=64):
+        '''
+        ### ARGUMENTS:
+        - path: output file
+        - rows: length of every column (None for a 1D array of scalars)
+        - dtype: data type on disk
+        - chunk: number of columns the file grows by at once
+        '''
+        self.path = path
+        self.rows = rows
+        self.dtype = np.dtype(dtype)
+        self.chunk = chunk
+        self.count = 0      # number of columns written
+        self._allocated = 0
+        self._column_bytes = (1 if rows is None else rows) * self.dtype.itemsize
+        self._file = open(path, 'wb+')
+        self._write_header()
+        return
+
+
+    @property
+    def shape(self):
+        return (self.count,) if self.rows is None else (self.rows, self.count)
+
+
+    def append(self, column):
+        '''
+        Add a column at the end of the file
+        '''
+        if self.count == self._allocated:
+            self._allocated += self.chunk
+            self._file.truncate(HEADER_SIZE + self._allocated * self._column_bytes)
+        self._file.seek(HEADER_SIZE + self.count * self._column_bytes)
+        self._file.write(np.asarray(column, dtype=self.dtype).tobytes())
+        self.count += 1
+        self._write_header()
+        return
+
+
+    def overwrite(self, index, column):
+        '''
+        Replace a column that was already written
+        '''
+        self._file.seek(HEADER_SIZE + index * self._column_bytes)
+        self._file.write(np.asarray(column, dtype=self.dtype).tobytes())
+        return
+
+
+    def flush(self):
+        self._file.flush()
+        return
+
+
+    def close(self):
+        # Drop the unused preallocation
+        self._file.truncate(HEADER_SIZE + self.count * self._column_bytes)
+        self._file.close()
+        return
+
+
+    def _write_header(self):
+        write_header(self._file, self.shape, self.dtype)
+        return
+
+
+class stream_recorder:
+    '''
+    Background writer of live frames to a recording (see the module documentation)
+    '''
+
+    def __init__(self, path, queue_size=8, dtype=np.float32, chunk=64, flush_interval=1.):
+        '''
+        ### ARGUMENTS:
+        - path: output .npy file (the frames go to <name>_frames.npy, the timestamps to <name>_timestamps.npy)
+        - queue_size: maximum number of frames waiting to be written
+        - dtype: data type of the frames on disk
+        - chunk: number of frames the file grows by at once
+        - flush_interval: time between updates of the mean voltage column on disk (s)
+        '''
+        self.path = path
+        self.frames_path = os.path.splitext(path)[0] + '_frames.npy'
+        self.timestamps_path = os.path.splitext(path)[0] + '_timestamps.npy'
+        self.queue_size = queue_size
+        self.dtype = dtype
+        self.chunk = chunk
+        self.flush_interval = flush_interval
+        self.frames = 0     # number of frames written
+        self.dropped = 0    # number of frames that were not recorded
+        self.error = None
+        self._free = queue.Queue()
+        self._pending = queue.Queue()
+        self._buffers = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='recorder', daemon=True)
+        self._thread.start()
+        return
+
+
+    def submit(self, timestamp, time_axis, volts):
+        '''
+        Queue a copy of a frame for writing, without ever blocking the caller
+
+        ### ARGUMENTS:
+        - timestamp: acquisition time of the frame (s since the epoch)
+        - time_axis: time of every point (s)
+        - volts: voltage of every point (V)
+
+        ### RETURNS:
+        - True if the frame was queued, False if it was dropped
+        '''
+        if self._closed or self.error is not None:
+            self.dropped += 1
+            return False
+        try:
+            buffer = self._free.get_nowait()
+        except queue.Empty:
+            if self._buffers == self.queue_size:
+                # The writer is behind
+                self.dropped += 1
+                return False
+            buffer = None
+            self._buffers += 1
+        if buffer is None or len(buffer) != len(volts):
+            buffer = np.empty(len(volts), dtype=np.float32)
+        np.copyto(buffer, volts)
+        self._pending.put((timestamp, time_axis, buffer))
+        return True
+
+
+    def close(self):
+        '''
+        Write the queued frames and finish the files
+        '''
+        if not self._closed:
+            self._closed = True
+            self._pending.put(None)
+            self._thread.join()
+        return
+
+
+    def _run(self):
+        record, frames, timestamps, total, reference = None, None, None, None, None
+        last_flush = time.monotonic()
+        try:
+            while True:
+                item = self._pending.get()
+                if item is None:
+                    break
+                timestamp, time_axis, volts = item
+                if self.error is not None:
+                    self.dropped += 1
+                elif frames is None:
+                    # The first frame sets the record length and time axis of the recording
+                    record = column_file(self.path, len(volts), np.float64, chunk=2)
+                    frames = column_file(self.frames_path, len(volts), self.dtype, self.chunk)
+                    timestamps = column_file(self.timestamps_path, None, np.float64, self.chunk)
+                    record.append(time_axis)
+                    record.append(volts)
+                    reference = time_axis
+                    total = volts.astype(np.float64)
+                elif time_axis is not reference and not np.array_equal(time_axis, reference):
+                    self.error = 'The record length or time base changed; restart the recording'
+                    self.dropped += 1
+                else:
+                    total += volts
+                if frames is not None and self.error is None:
+                    frames.append(volts)
+                    timestamps.append(timestamp)
+                    self.frames += 1
+                    if time.monotonic() - last_flush > self.flush_interval:
+                        record.overwrite(1, total / self.frames)
+                        record.flush()
+                        frames.flush()
+                        timestamps.flush()
+                        last_flush = time.monotonic()
+                self._free.put(volts)
+        except OSError as error:
+            self.error = error
+        finally:
+            if frames is not None:
+                try:
+                    record.overwrite(1, total / max(self.frames, 1))
+                    record.close()
+                    frames.close()
+                    timestamps.close()
+                except OSError as error:
+                    self.error = error
+        return
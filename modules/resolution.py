@@ -0,0 +1,109 @@
+'''
+Streaming resolution measurement of live frames
+
+Only a window around the target time is analysed: it is located by a binary search on the
+(monotonic) time axis, so the cost does not depend on the record length. The peak width (FWHM)
+is interpolated between samples instead of being truncated to whole samples, and the last few
+results of every scope are kept in a fixed-size ring for the statistics shown in the Live Feed.
+'''
+
+# Imports
+import numpy as np
+from scipy.signal import find_peaks, peak_widths
+from modules.decimation import index_range
+
+
+def measure(time_s, volts, target, window=1., prominence=10, baseline=0.):
+    '''
+    Mass resolution of the peak closest to the target time
+
+    ### ARGUMENTS:
+    - time_s: monotonic time axis (s)
+    - volts: (negative going) signal (V)
+    - target: time of the peak of interest (us)
+    - window: only the signal within target +/- window is analysed (us)
+    - prominence: minimum peak prominence (mV)
+    - baseline: baseline of the signal (mV)
+
+    ### RETURNS:
+    - resolution t / (2 FWHM) of the closest peak, or None if there is no peak in the window
+    '''
+    start, stop = index_range(time_s, (target - window) * 1e-6, (target + window) * 1e-6, monotonic=True)
+    if stop - start < 3:
+        return None
+    x_data = time_s[start:stop] * 1e6                       # us
+    y_data = -np.asarray(volts[start:stop], dtype=np.float64) * 1e3 - baseline   # mV
+    peaks, _ = find_peaks(y_data, prominence=prominence)
+    if len(peaks) == 0:
+        return None
+    the_chosen_one = peaks[np.argmin(np.abs(x_data[peaks] - target))]
+    # Full width at half maximum, with the crossings interpolated between samples
+    _, _, lips, rips = peak_widths(y_data, peaks=[the_chosen_one], rel_height=0.5)
+    positions = np.arange(len(x_data))
+    delta = np.interp(rips[0], positions, x_data) - np.interp(lips[0], positions, x_data)
+    if delta <= 0:
+        return None
+    return x_data[the_chosen_one] / (2 * delta)
+
+
+class resolution_stats:
+    '''
+    Fixed-size ring of the latest resolution measurements
+    '''
+
+    def __init__(self, size=5):
+        '''
+        ### ARGUMENTS:
+        - size: number of measurements the statistics are taken over
+        '''
+        self.size = size
+        self.values = np.full(size, np.nan)
+        self.count = 0      # number of measurements added
+        return
+
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+
+    def add(self, value):
+        self.values[self.count % self.size] = value
+        self.count += 1
+        return
+
+
+    def clear(self):
+        self.values[:] = np.nan
+        self.count = 0
+        return
+
+
+    def ordered(self):
+        # Measurements from old to new
+        if self.count <= self.size:
+            return self.values[:self.count]
+        return np.roll(self.values, -(self.count % self.size))
+
+
+    @property
+    def last(self):
+        return self.values[(self.count - 1) % self.size] if self.count > 0 else np.nan
+
+
+    @property
+    def mean(self):
+        return np.mean(self.ordered()) if self.count > 0 else np.nan
+
+
+    @property
+    def std(self):
+        return np.std(self.ordered()) if self.count > 1 else np.nan
+
+
+    @property
+    def trend(self):
+        # Slope of a straight line through the measurements (change per frame)
+        values = self.ordered()
+        if len(values) < 2:
+            return np.nan
+        return np.polyfit(np.arange(len(values)), values, 1)[0]
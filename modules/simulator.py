@@ -0,0 +1,269 @@
+'''
+Simulated MDO34 scope
+
+In-process stand-in for a pyvisa resource that answers the SCPI subset used by
+modules.johanpackage.scope (initialise, read, runstop, setNumAvg, ...) and modules.waveform,
+so the Live Feed path can be profiled and checked off the bench. The record is a synthetic
+time-of-flight spectrum with configurable record length, peaks, noise and round-trip latency.
+'''
+
+# Imports
+import time
+import threading
+import numpy as np
+from pyvisa.util import to_ieee_block, from_ieee_block
+
+
+# (long form, short form) of the supported SCPI mnemonics
+MNEMONICS = [('WFMOUTPRE', 'WFMO'), ('WFMPRE', 'WFMP'), ('YMULT', 'YMU'), ('YZERO', 'YZE'), ('YOFF', 'YOF'),
+             ('XINCR', 'XIN'), ('NR_PT', 'NR_P'), ('XZERO', 'XZE'), ('PT_OFF', 'PT_O'), ('DATA', 'DAT'),
+             ('SOURCE', 'SOU'), ('WIDTH', 'WID'), ('START', 'STAR'), ('STOP', 'STOP'), ('ENCDG', 'ENC'),
+             ('ACQUIRE', 'ACQ'), ('STATE', 'STATE'), ('MODE', 'MOD'), ('NUMAVG', 'NUMAV'), ('NUMACQ', 'NUMAC'),
+             ('HORIZONTAL', 'HOR'), ('SCALE', 'SCA'), ('POSITION', 'POS'), ('DELAY', 'DEL'), ('HEADER', 'HEAD'),
+             ('CURVE', 'CURV'), ('TRIGGER', 'TRIG'), ('EDGE', 'EDGE')]
+ALIASES = {'WFMPRE': 'WFMOUTPRE'}
+CANONICAL = {}
+for long_form, short_form in MNEMONICS:
+    CANONICAL[long_form] = ALIASES.get(long_form, long_form)
+    CANONICAL[short_form] = ALIASES.get(long_form, long_form)
+
+RECORDS = 4     # number of distinct noisy records per setting
+DEFAULT_PEAKS = [(4., 0.3), (20., 1.), (40., 0.6), (58.93, 0.8), (117.87, 0.4)]     # (mass (amu), amplitude (V))
+
+
+def parse(message):
+    '''
+    Split a (compound) SCPI message into canonical headers and arguments
+
+    ### ARGUMENTS:
+    - message: e.g. ':WFMOutpre:YMUlt?;YZEro?' or ':DATA:SOUrce CH1'
+
+    ### RETURNS:
+    - list of (header, argument) with header like 'WFMOUTPRE:YMULT?' and argument a string or None
+    '''
+    commands = []
+    path = []
+    for part in message.strip().split(';'):
+        part = part.strip()
+        if part == '':
+            continue
+        header, _, argument = part.partition(' ')
+        query = header.endswith('?')
+        header = header.rstrip('?')
+        if header.startswith('*'):
+            commands.append((header.upper() + ('?' if query else ''), argument.strip() or None))
+            continue
+        tokens = [CANONICAL.get(token.upper(), token.upper()) for token in header.lstrip(':').split(':')]
+        if not header.startswith(':') and len(commands) > 0:
+            tokens = path + tokens      # Relative to the previous command's subsystem
+        path = tokens[:-1]
+        commands.append((':'.join(tokens) + ('?' if query else ''), argument.strip() or None))
+    return commands
+
+
+class simulated_mdo34:
+    '''
+    Simulated MDO34 resource (write, query, query_binary_values, close)
+    '''
+
+    def __init__(self, serial='C000000', record_length=1000000, latency=1e-3, bandwidth=40e6,
+                 trigger_rate=10., peaks=DEFAULT_PEAKS, calibration=(0.09949062, 0.23745731),
+                 peak_width=0.02, noise=2e-3, seed=0):
+        '''
+        ### ARGUMENTS:
+        - serial: serial number reported by *IDN?
+        - record_length: number of points per record
+        - latency: time per round-trip (s)
+        - bandwidth: transfer rate of the curve (bytes/s)
+        - trigger_rate: acquisitions per second
+        - peaks: list of (mass (amu), amplitude (V)) of the synthetic peaks
+        - calibration: (a, k) of m = a(t-k)^2, t in us
+        - peak_width: peak standard deviation (us)
+        - noise: noise standard deviation of a single acquisition (V)
+        - seed: random seed
+        '''
+        self.serial = serial
+        self.record_length = record_length
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.trigger_rate = trigger_rate
+        self.peaks = peaks
+        self.calibration = calibration
+        self.peak_width = peak_width
+        self.noise = noise
+        self.timeout = 2000
+        self.settings = {'DATA:SOURCE': 'CH1', 'DATA:WIDTH': '1', 'DATA:STOP': str(record_length),
+                         'DATA:ENCDG': 'RPB', 'ACQUIRE:STATE': 'RUN', 'ACQUIRE:MODE': 'SAMPLE',
+                         'ACQUIRE:NUMAVG': '16', 'HORIZONTAL:SCALE': '2.0E-5', 'HORIZONTAL:POSITION': '10',
+                         'HEADER': '1'}
+        self.round_trips = 0
+        self._rng = np.random.default_rng(seed)
+        self._noise = self._rng.normal(0, 1, 2**16 + 1).astype(np.float32)
+        self._template = None
+        self._records = []
+        self._served = 0
+        self._started = time.monotonic()
+        self._stopped_count = 0
+        self._lock = threading.Lock()
+        return
+
+
+    # Waveform properties
+    def vertical(self):
+        # (ymult, yzero, yoff): 25 levels per division at 50 mV/div (width 1), 256x finer for width 2
+        width = int(self.settings['DATA:WIDTH'])
+        return 0.05 / 25 / 256**(width - 1), 0., 128. * 256**(width - 1)
+
+    def horizontal(self):
+        # (xincr, xzero, pt_off): 10 divisions over the record
+        xincr = float(self.settings['HORIZONTAL:SCALE']) * 10 / self.record_length
+        pt_off = int(self.record_length * float(self.settings['HORIZONTAL:POSITION']) / 100)
+        return xincr, 0., pt_off
+
+    def acquisitions(self):
+        # Number of acquisitions since the last (re)start
+        if self.settings['ACQUIRE:STATE'] != 'RUN':
+            return self._stopped_count
+        return int((time.monotonic() - self._started) * self.trigger_rate)
+
+    def restart(self):
+        # Settings changes restart the acquisition (and the averaging)
+        self._started = time.monotonic()
+        self._template = None
+        self._records = []
+        return
+
+
+    def template(self):
+        '''
+        Noise-free record (V), rebuilt when the horizontal settings change
+        '''
+        if self._template is None:
+            xincr, xzero, pt_off = self.horizontal()
+            t = (np.arange(self.record_length) - pt_off) * xincr * 1e6 + xzero  # us
+            a, k = self.calibration
+            volts = np.zeros(self.record_length, dtype=np.float32)
+            for mass, amplitude in self.peaks:
+                centre = k + np.sqrt(mass / a)
+                low, high = np.searchsorted(t, [centre - 6 * self.peak_width, centre + 6 * self.peak_width])
+                volts[low:high] -= amplitude * np.exp(-0.5 * ((t[low:high] - centre) / self.peak_width)**2)
+            self._template = volts
+        return self._template
+
+
+    def curve(self):
+        '''
+        Current record as an IEEE 488.2 block of unsigned digitising levels
+
+        A few noisy records are generated per setting and then cycled through, so producing a
+        record costs (almost) nothing compared to the transfer that is being simulated
+        '''
+        if len(self._records) < RECORDS:
+            averages = int(self.settings['ACQUIRE:NUMAVG']) if self.settings['ACQUIRE:MODE'].startswith('AVE') else 1
+            noise = np.resize(self._noise[self._rng.integers(0, len(self._noise)):], self.record_length)
+            volts = self.template() + noise * np.float32(self.noise / np.sqrt(averages))
+            ymult, yzero, yoff = self.vertical()
+            width = int(self.settings['DATA:WIDTH'])
+            levels = np.clip(np.rint((volts - yzero) / ymult + yoff), 0, 2**(8 * width) - 1).astype('>u%d' % width)
+            self._records.append(bytes(to_ieee_block(levels.tobytes(), datatype='B')))
+        self._served = (self._served + 1) % len(self._records)
+        return self._records[self._served]
+
+
+    # Resource interface
+    def _round_trip(self, size=0):
+        self.round_trips += 1
+        time.sleep(self.latency + size / self.bandwidth)
+        return
+
+
+    def write(self, message):
+        with self._lock:
+            self._round_trip()
+            for header, argument in parse(message):
+                self._command(header, argument)
+        return
+
+
+    def query(self, message):
+        with self._lock:
+            self._round_trip()
+            answers = []
+            for header, argument in parse(message):
+                answer = self._command(header, argument)
+                if answer is not None:
+                    answers.append(answer)
+            return ';'.join(answers) + '\n'
+
+
+    def query_binary_values(self, message, datatype='b', is_big_endian=False, container=list, **kwargs):
+        with self._lock:
+            if parse(message)[0][0] != 'CURVE?':
+                raise ValueError('Only curve? is supported as a binary query')
+            block = self.curve()
+            self._round_trip(len(block))
+        return from_ieee_block(block, datatype, is_big_endian, container)
+
+
+    def close(self):
+        return
+
+
+    def _command(self, header, argument):
+        # Execute one canonical command, return the answer of a query
+        if header == '*IDN?':
+            return 'TEKTRONIX,MDO34,%s,CF:91.1CT FV:v1.0 (simulated)' % self.serial
+        if header in ('WFMOUTPRE:YMULT?', 'WFMOUTPRE:YZERO?', 'WFMOUTPRE:YOFF?'):
+            ymult, yzero, yoff = self.vertical()
+            return repr({'WFMOUTPRE:YMULT?': ymult, 'WFMOUTPRE:YZERO?': yzero, 'WFMOUTPRE:YOFF?': yoff}[header])
+        if header in ('WFMOUTPRE:XINCR?', 'WFMOUTPRE:XZERO?', 'WFMOUTPRE:PT_OFF?'):
+            xincr, xzero, pt_off = self.horizontal()
+            return repr({'WFMOUTPRE:XINCR?': xincr, 'WFMOUTPRE:XZERO?': xzero, 'WFMOUTPRE:PT_OFF?': pt_off}[header])
+        if header == 'WFMOUTPRE:NR_PT?':
+            return str(min(self.record_length, int(self.settings['DATA:STOP'])))
+        if header == 'ACQUIRE:NUMACQ?':
+            return str(self.acquisitions())
+        if header.endswith('?'):
+            return self.settings.get(header[:-1], '0')
+        # Settings
+        if header == 'ACQUIRE:STATE':
+            argument = 'RUN' if argument.upper() in ('RUN', 'ON', '1') else 'STOP'
+            if argument == 'STOP':
+                self._stopped_count = self.acquisitions()
+            elif self.settings['ACQUIRE:STATE'] != 'RUN':
+                self.restart()
+        elif header == 'ACQUIRE:MODE':
+            argument = 'AVERAGE' if argument.upper().startswith('AVE') else 'SAMPLE'
+        self.settings[header] = argument
+        if header in ('HORIZONTAL:SCALE', 'HORIZONTAL:POSITION', 'ACQUIRE:MODE', 'ACQUIRE:NUMAVG', 'DATA:WIDTH'):
+            self.restart()
+        return None
+
+
+def resource_name(port, serial):
+    '''
+    VISA resource name of an MDO34 on a port, e.g. 'USB0::0x0699::0x0408::C019998::INSTR'
+    '''
+    return '%s::0x0699::0x0408::%s::INSTR' % (port, serial)
+
+
+class simulated_resource_manager:
+    '''
+    Stand-in for pyvisa.ResourceManager serving simulated scopes (see johanpackage.scope.use_resource_manager)
+    '''
+
+    def __init__(self, scopes):
+        '''
+        ### ARGUMENTS:
+        - scopes: dictionary of resource name (e.g. 'USB0::0x0699::0x0408::C019998::INSTR') -> simulated_mdo34
+        '''
+        self.scopes = scopes
+        return
+
+
+    def list_resources(self):
+        return tuple(self.scopes)
+
+
+    def open_resource(self, name):
+        return self.scopes[name]
@@ -0,0 +1,138 @@
+'''
+Least squares (Whittaker) smoothing
+
+Solves (I + lam*D·Dᵀ) z = y, with D the second order difference matrix.
+The system is symmetric positive-definite and pentadiagonal, so it is stored in LAPACK's
+upper banded form (3 rows) and solved with a banded Cholesky decomposition in linear time.
+SciPy is only imported when something is smoothed, which keeps it out of the app's startup.
+
+Asymmetric least squares (AsLS) estimates a baseline from the signal itself by solving
+(W + lam*D·Dᵀ) z = W y repeatedly, with small weights for the points above the current estimate
+(the peaks) and large weights for the points below it.
+'''
+
+# Imports
+import numpy as np
+from modules import instrumentation
+
+
+def penalty_bands(size, lam):
+    '''
+    Build I + lam*D·Dᵀ in upper banded form
+
+    ### ARGUMENTS:
+    - size: number of data points
+    - lam: smoothness parameter
+
+    ### RETURNS:
+    - ab: (3, size) array; row 2 is the main diagonal, rows 1 and 0 the first and second super-diagonal
+    '''
+    ab = np.zeros((3, size))
+    ## Main diagonal: 1, 5, 6, ..., 6, 5, 1
+    ab[2, :size-2] += 1
+    ab[2, 1:size-1] += 4
+    ab[2, 2:] += 1
+    ## First super-diagonal: -2, -4, ..., -4, -2
+    ab[1, 1:size-1] -= 2
+    ab[1, 2:] -= 2
+    ## Second super-diagonal: 1, ..., 1
+    ab[0, 2:] = 1
+    ab *= lam
+    ab[2] += 1
+    return ab
+
+
+@instrumentation.timed
+def factorise(size, lam):
+    '''
+    Cholesky factorisation of I + lam*D·Dᵀ, to be reused for several right hand sides
+
+    ### ARGUMENTS:
+    - size: number of data points
+    - lam: smoothness parameter
+
+    ### RETURNS:
+    - factor: banded Cholesky factor (pass on to solve)
+    '''
+    if size < 3:
+        return None
+    from scipy.linalg import cholesky_banded
+    return cholesky_banded(penalty_bands(size, lam), overwrite_ab=True, check_finite=False)
+
+
+@instrumentation.timed
+def solve(factor, y):
+    '''
+    Smooth one or more signals with a precomputed factorisation
+
+    ### ARGUMENTS:
+    - factor: output of factorise
+    - y: signal (size,) or signals stacked as columns (size, n)
+
+    ### RETURNS:
+    - z: smoothed signal(s), same shape as y
+    '''
+    if factor is None:
+        return np.array(y, dtype=float)
+    from scipy.linalg import cho_solve_banded
+    return cho_solve_banded((factor, False), y, check_finite=False)
+
+
+@instrumentation.timed
+def smooth(y, lam):
+    '''
+    Least Squares Smoothing
+
+    ### ARGUMENTS:
+    - y: signal
+    - lam: smoothness parameter
+
+    ### RETURNS:
+    - z: smoothed signal
+    '''
+    size = len(y)
+    if size < 3:
+        return np.array(y, dtype=float)
+    from scipy.linalg import solveh_banded
+    return solveh_banded(penalty_bands(size, lam), y, overwrite_ab=True, check_finite=False)
+
+
+
+@instrumentation.timed
+def asls(y, lam, p=0.01, iterations=20, mask=None, tolerance=1e-4):
+    '''
+    Asymmetric least squares baseline of a signal with positive peaks
+
+    ### ARGUMENTS:
+    - y: signal
+    - lam: smoothness parameter
+    - p: weight of the points above the baseline (1 - p for the points below it)
+    - iterations: maximum number of reweighting steps
+    - mask: points above the baseline of an earlier estimate (e.g. with another lambda) to start
+            from, None starts from equal weights
+    - tolerance: stop when less than this fraction of the points changes side
+
+    ### RETURNS:
+    - z: baseline
+    - mask: points above the baseline (to warm start a next estimate)
+    '''
+    from scipy.linalg import solveh_banded
+    y = np.asarray(y, dtype=np.float64)
+    size = len(y)
+    if size < 3:
+        return y.copy(), np.zeros(size, dtype=bool)
+    penalty = penalty_bands(size, lam)
+    penalty[2] -= 1     # only lam*D·Dᵀ, the weights take the place of the identity
+    weights = np.ones(size) if mask is None else np.where(mask, p, 1 - p)
+    ab = np.empty_like(penalty)
+    for _ in range(iterations):
+        ab[:] = penalty
+        ab[2] += weights
+        z = solveh_banded(ab, weights * y, overwrite_ab=True, check_finite=False)
+        above = y > z
+        changed = size if mask is None else np.count_nonzero(above != mask)
+        mask = above
+        weights = np.where(mask, p, 1 - p)
+        if changed < tolerance * size:
+            break
+    return z, mask
@@ -0,0 +1,253 @@
+'''
+Incremental bookkeeping of the spectra shown in the visualiser
+
+Every selected file gets its own entry, so selecting a file only loads that file, deselecting
+drops it, and a new calibration only recomputes the mass axis.
+Each entry is a memory-mapped load_data with a contiguous float32 voltage and float64 time and
+mass axes: memory scales with the number of samples, and there is no long-format frame repeating
+the file name for every sample.
+
+The processing of every spectrum is a chain of stages, each memoised on its own inputs:
+- load: path and modification time of the file
+- baseline: load key, baseline file (and its modification time), lambda and multiplier
+- calibrate: load key, a and k
+- crop: baseline and calibrate keys, axis and shown range -> index range
+- plot: crop key and plot width -> decimated trace
+A change only redoes its own stage and the ones after it, and every stage counts its hits and
+misses (see spectrum_store.stats).
+'''
+
+# Imports
+import os
+import numpy as np
+from modules import cache
+from modules.calibration import load_data, baseline_correction
+from modules.decimation import pyramid, index_range
+from modules import instrumentation
+
+
+class stage:
+    '''
+    Key each spectrum was last processed with by one stage, with hit and miss counts
+    '''
+
+    def __init__(self):
+        self.keys = {}  # name -> key
+        self.hits = 0
+        self.misses = 0
+        return
+
+
+    def fresh(self, name, key):
+        '''
+        Whether a spectrum was last processed with this key (counted as a hit or a miss)
+        '''
+        if name in self.keys and self.keys[name] == key:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+
+    def done(self, name, key):
+        self.keys[name] = key
+        return
+
+
+    def drop(self, name):
+        self.keys.pop(name, None)
+        return
+
+
+def file_key(path):
+    '''
+    Identity of a file's content: its path and modification time
+    '''
+    try:
+        return (os.path.abspath(path), os.path.getmtime(path))
+    except (OSError, TypeError):
+        return (path, None)
+
+
+class spectrum_store:
+    '''
+    Per-file spectra keyed by name, with the settings that were last applied to them
+    '''
+
+    def __init__(self, dtype=np.float32):
+        '''
+        ### ARGUMENTS:
+        - dtype: floating point type of the stored voltages (time and mass are float64)
+        '''
+        self.dtype = dtype
+        self.spectra = {}   # name -> load_data
+        self.calibration = None
+        self.baseline = None    # (file, lam, multiplier) of the last baseline correction
+        self.baselines = {}  # name -> (file, lam, multiplier) of the applied baseline correction
+        self.pyramids = {}  # name -> decimation pyramid of the voltage
+        self.stages = {'load': stage(),
+                       'baseline': stage(),
+                       'calibrate': stage(),
+                       'crop': cache.lru(maxsize=64),     # key -> (start, stop)
+                       'plot': cache.lru(maxsize=64)}     # key -> (x, voltage)
+        return
+
+
+    def __len__(self):
+        return len(self.spectra)
+
+
+    def __contains__(self, name):
+        return name in self.spectra
+
+
+    def __getitem__(self, name):
+        return self.spectra[name]
+
+
+    def items(self):
+        return self.spectra.items()
+
+
+    @instrumentation.timed
+    def select(self, files, init_param):
+        '''
+        Synchronise the store with the selected files
+
+        ### ARGUMENTS:
+        - files: dictionary of name -> path, in the order they should be shown
+        - init_param: calibration parameters (a, k) for newly loaded files
+
+        ### RETURNS:
+        - list of names that were newly loaded
+        '''
+        # Drop deselected files
+        for name in list(self.spectra):
+            if name not in files:
+                self.drop(name)
+
+        # Load new (or changed) files only
+        added = []
+        for name, path in files.items():
+            key = file_key(path)
+            if not self.stages['load'].fresh(name, key):
+                self.drop(name)
+                self.spectra[name] = load_data(path, init_param, lazy=True, dtype=self.dtype)
+                self.stages['load'].done(name, key)
+                added.append(name)
+
+        # Keep the selection order
+        self.spectra = {name: self.spectra[name] for name in files}
+        return added
+
+
+    def drop(self, name):
+        '''
+        Forget a spectrum and everything that was derived from it
+        '''
+        self.spectra.pop(name, None)
+        self.baselines.pop(name, None)
+        self.pyramids.pop(name, None)
+        for memo in self.stages.values():
+            if isinstance(memo, stage):
+                memo.drop(name)
+        return
+
+
+    def stats(self):
+        '''
+        Hit and miss counts of every stage
+
+        ### RETURNS:
+        - dictionary of stage -> (hits, misses)
+        '''
+        return {name: (memo.hits, memo.misses) for name, memo in self.stages.items()}
+
+
+    @instrumentation.timed
+    def calibrate(self, a, k):
+        '''
+        Apply a mass calibration to every spectrum that does not have it yet
+        '''
+        for name, data in self.spectra.items():
+            key = (self.stages['load'].keys.get(name), a, k)
+            if not self.stages['calibrate'].fresh(name, key):
+                data.calibrate(a, k)
+                self.stages['calibrate'].done(name, key)
+        self.calibration = (a, k)
+        return
+
+
+    @instrumentation.timed
+    def baseline_correction(self, lam, multiplier, baseline_data, persist=False):
+        '''
+        Apply the baseline correction to every spectrum that does not have these settings yet
+
+        ### ARGUMENTS:
+        - lam, multiplier, baseline_data, persist: see load_data.baseline_correction
+
+        Raises a ValueError naming the spectra the baseline does not fit (another record length);
+        those keep their previous correction, all others are corrected
+        '''
+        settings = (baseline_data, lam, multiplier)
+        self.baseline = None if baseline_data is None else settings
+        # A rewritten baseline file invalidates the correction as well
+        reference = file_key(baseline_data) if baseline_data is not None else None
+        outdated = []
+        for name, data in self.spectra.items():
+            key = (self.stages['load'].keys.get(name), reference, lam, multiplier)
+            if baseline_data is None:
+                key = (self.stages['load'].keys.get(name), None)
+            if not self.stages['baseline'].fresh(name, key):
+                outdated.append((name, key))
+        # One batched correction for all outdated spectra
+        failed = baseline_correction([self.spectra[name] for name, _ in outdated], lam, multiplier, baseline_data, persist)
+        failed = [name for name, _ in outdated if any(self.spectra[name] is data for data in failed)]
+        for name, key in outdated:
+            if name not in failed:
+                self.stages['baseline'].done(name, key)
+                self.baselines[name] = settings
+                self.pyramids.pop(name, None)
+        if len(failed) > 0:
+            raise ValueError('The baseline does not have the length of ' + ', '.join(failed))
+        return
+
+
+    @instrumentation.timed
+    def decimated(self, name, axis, view=None, width=1500):
+        '''
+        Min/max decimated trace of one spectrum for plotting
+
+        ### ARGUMENTS:
+        - name: spectrum
+        - axis: 'time' or 'mass'
+        - view: (x0, x1) range that is shown, None for everything
+        - width: plot width in pixels (about 2 points per pixel are returned)
+
+        ### RETURNS:
+        - x, voltage
+        '''
+        data = self.spectra[name]
+        upstream = (self.stages['load'].keys.get(name), self.stages['baseline'].keys.get(name))
+        if axis == 'mass':
+            upstream += (self.stages['calibrate'].keys.get(name),)
+        key = upstream + (axis, view, width)
+        trace = self.stages['plot'].get(key)
+        if trace is None:
+            x = getattr(data, axis)
+            ## Crop
+            crop_key = upstream + (axis, view)
+            limits = self.stages['crop'].get(crop_key)
+            if limits is None:
+                if view is None:
+                    limits = (0, len(x))
+                else:
+                    limits = index_range(x, *view, monotonic=(axis == 'time'))
+                self.stages['crop'].put(crop_key, limits)
+            ## Decimate
+            if name not in self.pyramids:
+                self.pyramids[name] = pyramid(data.voltage)
+            indices = self.pyramids[name].query(*limits, width)
+            trace = (x[indices], data.voltage[indices])
+            self.stages['plot'].put(key, trace)
+        return trace
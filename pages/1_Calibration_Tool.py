@@ -3,14 +3,17 @@ from scipy.optimize import fsolve, curve_fit
 from warnings import catch_warnings
 import toml
 from datetime import datetime
-import plotly.express as px
+import plotly.graph_objects as go
 import pandas as pd
 import numpy as np
+from modules.autocalibration import auto_calibrate, MIN_MATCHES
+from modules import instrumentation
 
 
 # Information
 st.set_page_config(layout='wide')
 st.write("# Manual Calibration Tool")
+instrumentation.begin_rerun('Calibration Tool')
 
 
 # Figure
@@ -28,17 +31,37 @@ def generate_fig():
             xaxis=dict(showgrid=True),
             uirevision=True)
     
-    # Time Spectrum
-    fig = px.line(st.session_state['dataframe'], x='time', y='voltage', color='name')
+    # Time Spectrum (one trace per spectrum in the visualiser's store)
+    fig = go.Figure()
+    if 'store' in st.session_state:
+        for name in st.session_state['store'].spectra:
+            x, y = st.session_state['store'].decimated(name, 'time')     # min/max decimated
+            fig.add_trace(go.Scatter(x=x, y=y, mode='lines', name=name, showlegend=True))
     prepare_axes('time (us)', 'accumulated voltage (V)')
     
     return fig
 
-st.plotly_chart(generate_fig())
+with instrumentation.span('figure'):
+    fig = generate_fig()
+with instrumentation.span('plotly_chart'):
+    st.plotly_chart(fig)
 
 
+# Mode
+mode = st.radio('Mode', ['Manual', 'Automatic'], horizontal=True)
+
 # Input
-edited_df = st.data_editor(pd.DataFrame({'Time':[], 'Mass':[]}), num_rows="dynamic", width=500)
+if mode == 'Manual':
+    edited_df = st.data_editor(pd.DataFrame({'Time':[], 'Mass':[]}), num_rows="dynamic", width=500)
+else:
+    spectra = st.session_state['store'].spectra if 'store' in st.session_state else {}
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        auto_spectrum = st.selectbox('Spectrum', list(spectra))
+    with col2:
+        auto_prominence = st.number_input('Minimum prominence (V)', min_value=0., value=1e-3, step=1e-4, format='%.4f')
+    with col3:
+        auto_tolerance = st.number_input('Tolerance (amu)', min_value=0.01, value=0.5)
 
 # Optimise
 def optimise():
@@ -54,9 +77,26 @@ def optimise():
     except:
         return 0, 0
     return popt[0], popt[1]
+
+def optimise_auto():
+    '''
+    Match the peaks of the chosen spectrum against the library (masses.npy)
+
+    Keeps the current calibration if too few peaks match
+    '''
+    calibration = (st.session_state.get('a', 0.09), st.session_state.get('k', 0.2))
+    if auto_spectrum is None:
+        return calibration[0], calibration[1], None
+    data = spectra[auto_spectrum]
+    popt, matches = auto_calibrate(data.time, data.voltage, calibration,
+                                   prominence=auto_prominence, tolerance=auto_tolerance)
+    if popt is None:
+        return calibration[0], calibration[1], None
+    return popt[0], popt[1], matches
     
 
 # Output
+@instrumentation.callback
 def apply(a, k):
     today = datetime.now()
 
@@ -85,13 +125,25 @@ def apply(a, k):
 with st.container(border=True):
     st.write('## Solution')
     with catch_warnings(record=True) as w:
-        a, k = optimise()
+        with instrumentation.span('fit'):
+            if mode == 'Manual':
+                a, k = optimise()
+            else:
+                a, k, matches = optimise_auto()
     st.write("#### a = `%.5f` amu/μs$^{2}$" % a)
     st.write("#### k = `%.5f` μs" % k)
     st.button('Apply', on_click=lambda: apply(a, k))
+    if mode == 'Automatic' and matches is None and auto_spectrum is not None:
+        st.warning('Fewer than %d peaks matched the library: the current calibration is kept' % MIN_MATCHES)
+    if mode == 'Automatic' and matches is not None:
+        st.write('Matched peaks (mass, fitted mass and residual in amu)')
+        st.dataframe(matches, hide_index=True)
 
 # Show warning if applicable
 if len(w) != 0:
     with st.container(border=True):
         for warning in w:
-            st.write(warning)
\ No newline at end of file
+            st.write(warning)
+
+# Performance of this rerun
+instrumentation.panel('Calibration Tool', instrumentation.end())
@@ -1,23 +1,73 @@
+import os
+import time
+import uuid
 import streamlit as st
 import modules.johanpackage.scope as scope
 import plotly.graph_objects as go
-import time
-from scipy.signal import find_peaks, peak_widths
 import numpy as np
+from modules.decimation import index_range, minmax
+from modules import waveform
+from modules import instrumentation
+from modules.acquisition import acquisition_worker
+from modules.recording import stream_recorder
+from modules.resolution import measure, resolution_stats
+from modules.simulator import simulated_mdo34, simulated_resource_manager, resource_name
+
+PLOT_WIDTH = 1500   # px, about two points per pixel are sent to the browser
+PREAMBLE_AGE = 5    # s, picks up changes made on the scope's front panel
+
+# Instrumentation (see modules.instrumentation); johanpackage itself is not edited
+PROFILE = instrumentation.begin_rerun('Live Feed')
+instrumentation.instrument(scope, ['initialise', 'read', 'runstop', 'setMicPdiv', 'getMicPdiv', 'setSampleMode', 'setNumAvg'])
+
+# Acquisition: one background worker per scope, shared by all sessions and kept across reruns.
+# A worker runs while any session has Run on; recordings are per session.
+SIMULATE = os.environ.get('FCS_SIMULATE', '') not in ('', '0')   # Simulated scopes, e.g. to test off the bench
+SCOPES = {'scope1': ("MDO34_Primary", "MDO34_SN_Primary", 'primary'),
+          'scope2': ("MDO34_Secondary", "MDO34_SN_Secondary", 'secondary')}
+
+if 'lf_owner' not in st.session_state:
+    st.session_state['lf_owner'] = uuid.uuid4().hex
+OWNER = st.session_state['lf_owner']
+
+@st.cache_resource
+def simulated_instruments():
+    # Simulated MDO34s on the ports and with the serial numbers of channelassignments.ini
+    scopes = {}
+    for seed, (port, SN, _) in enumerate(SCOPES.values()):
+        serial = scope.configchn.get("PORTS", SN)
+        scopes[resource_name(scope.configchn.get("PORTS", port), serial)] = simulated_mdo34(serial, seed=seed)
+    return simulated_resource_manager(scopes)
+
+if SIMULATE:
+    scope.use_resource_manager(simulated_instruments())
+
+@st.cache_resource
+def start_acquisition(scope_str, simulate):
+    # Raises if the scope cannot be connected: failures are not cached, so they are retried on the next rerun
+    # (simulate only keeps simulated and real connections apart in the cache)
+    port, SN, _ = SCOPES[scope_str]
+    scope_obj = scope.initialise(port, SN)
+    return acquisition_worker(waveform.scope_session(scope_obj, max_age=PREAMBLE_AGE))
+
+def reconnect():
+    # Drop the connections of every session, e.g. after a scope was unplugged
+    for worker in workers.values():
+        worker.close()
+    start_acquisition.clear()
+
+workers = {}
+with instrumentation.span('connect'):
+    for scope_str in SCOPES:
+        try:
+            workers[scope_str] = start_acquisition(scope_str, SIMULATE)
+        except Exception:
+            continue
+for scope_str, (_, _, label) in SCOPES.items():
+    if scope_str not in workers:
+        st.warning("Couldn't connect with the " + label + " scope")
 
 # Initialise Session State
-if 'scope1' not in st.session_state:
-    try:
-        scope1 = scope.initialise("MDO34_Primary","MDO34_SN_Primary")
-        st.session_state['scope1'] = scope1
-    except:
-        st.warning("Couldn't connect with the primary scope")
-if 'scope2' not in st.session_state:
-    try:
-        scope2 = scope.initialise("MDO34_Secondary","MDO34_SN_Secondary")
-        st.session_state['scope2'] = scope2
-    except:
-        st.warning("Couldn't connect with the secondary scope")
 if 'fig1' not in st.session_state:
     fig = go.Figure()
     fig.add_trace(go.Scatter(x=[], y=[], mode='lines'))
@@ -37,68 +87,57 @@ if 'R_toggle' not in st.session_state:
     st.session_state['R_toggle'] = False
 if 'target' not in st.session_state:
     st.session_state['target'] = 0.0
-if 'avg' not in st.session_state:
-    st.session_state['avg'] = np.zeros(5)
+if 'R_window' not in st.session_state:
+    st.session_state['R_window'] = 1.0
+if 'R_stats' not in st.session_state:
+    st.session_state['R_stats'] = {scope_str: resolution_stats(5) for scope_str in SCOPES}
 if 'lf_baseline' not in st.session_state:
     st.session_state['lf_baseline'] = 0.0
+if 'record' not in st.session_state:
+    st.session_state['record'] = False
+if 'record_directory' not in st.session_state:
+    st.session_state['record_directory'] = st.session_state.get('directory', os.getcwd())
+if 'record_name' not in st.session_state:
+    st.session_state['record_name'] = 'stream'
 
-# Define Reading Function
-def output(scope_str, fig_frame, R_frame):
+# Define Plotting Function
+def output(time_s, volts, fig_frame, R_frame, stats):
     # Initialise
-    time.sleep(3.2) # Wait until all data in the 32 avg is new
     fig = st.session_state['fig1']
 
-    # Read Data
-    try:
-        scope_obj = st.session_state[scope_str]
-    except KeyError:
-        if scope_str == 'scope1':
-            st.error("Couldn't connect to the primary scope")
-        else:
-            st.error("Couldn't connect to the secondary scope")
-        return False
-    else:
-        data = scope.read('CH1', scope_obj)
-
-        # Generate figure
-        fig.data[0].x = data[:, 0] * 1e6    # us
-        fig.data[0].y = data[:, 1] * 1e3 - st.session_state['lf_baseline']  # mV
-        fig.update_layout(
-            yaxis_range=[st.session_state['y_min'], st.session_state['y_max']], 
-            xaxis_range=[st.session_state['x_min'], st.session_state['x_max']])
-        fig_frame.plotly_chart(fig, use_container_width=True)
-        
-        # Calculate Resolution
-        if st.session_state['R_toggle']:
-            # Extract data
-            x_data = data[:, 0]*1e6 # us
-            y_data = -data[:,1]*1e3 - st.session_state['lf_baseline']   # mV
-            # Find Peaks
-            peaks, _ = find_peaks(y_data, prominence=10)
-            ## Calculate which peak is closest to target
-            diff = np.abs(x_data[peaks] - st.session_state['target'])
-            try:
-                the_chosen_one = peaks[np.argmin(diff)]
-            except ValueError:
-                R_frame.error('No Peaks found')
-            ## Calcualte peak width (in index number...)
-            _, _, lips, rips = peak_widths(y_data, peaks=[the_chosen_one])
-            delta = x_data[int(rips[0])] - x_data[int(lips[0])] # Convert peak width to time units
-            # Calculate Resolution
-            R = st.session_state['target'] / (2*delta)
-            st.session_state['avg'] = np.append(st.session_state['avg'], R)
-            st.session_state['avg'] = np.delete(st.session_state['avg'], 0)
-            avg = np.average(st.session_state['avg'])
-            R_frame.success(f'Resolution = {R:.1f} \
-                             \nAverage (5 cycles) = {avg:.1f}')
-
-        return True
+    # Generate figure (min/max decimated within the shown time range)
+    start, stop = index_range(time_s, st.session_state['x_min'] * 1e-6, st.session_state['x_max'] * 1e-6, monotonic=True)
+    shown = minmax(volts, start, stop, PLOT_WIDTH)
+    fig.data[0].x = time_s[shown] * 1e6     # us
+    fig.data[0].y = volts[shown] * 1e3 - st.session_state['lf_baseline']  # mV
+    fig.update_layout(
+        yaxis_range=[st.session_state['y_min'], st.session_state['y_max']], 
+        xaxis_range=[st.session_state['x_min'], st.session_state['x_max']])
+    fig_frame.plotly_chart(fig, use_container_width=True)
+    
+    # Calculate Resolution (only around the target, see modules.resolution)
+    if st.session_state['R_toggle']:
+        R = measure(time_s, volts, st.session_state['target'], st.session_state['R_window'],
+                    baseline=st.session_state['lf_baseline'])
+        if R is None:
+            R_frame.error('No Peaks found')
+            return
+        stats.add(R)
+        R_frame.success(f'Resolution = {R:.1f} \
+                         \nAverage ({len(stats)} cycles) = {stats.mean:.1f} ± {np.nan_to_num(stats.std):.1f} \
+                         \nTrend = {np.nan_to_num(stats.trend):+.1f} per cycle')
+
+    return
 
 
 # Side Bar
 with st.sidebar:
     # Standard Settings
     st.toggle('Run/Stop', key='run')
+    others = max([worker.owners for worker in workers.values()], default=0)   # this session's loop has stopped for the rerun
+    if others > 0:
+        st.caption(f'The scopes are also running for {others} other session(s)')
+    st.button('Reconnect', on_click=reconnect, help='Connect the scopes again (for every session)')
     col1, col2 = st.columns(2)
     with col1:
         st.number_input('x$_{min}$', key='x_min')
@@ -113,6 +152,15 @@ with st.sidebar:
         st.header('Resolution')
         st.toggle('Toggle Resolution', key='R_toggle')
         st.number_input('At what time?', min_value=0.0, key='target')
+        st.number_input('Window (us)', min_value=0.01, key='R_window', help='Only the signal within this distance of the target time is analysed')
+
+    # Recording
+    with st.container(border=True):
+        st.header('Record')
+        st.text_input('Directory', key='record_directory')
+        st.text_input('Name', key='record_name')
+        st.toggle('Record every frame', key='record')
+        record_status = st.empty()
 
 # Primary Scope
 with st.container(border=True):
@@ -130,10 +178,87 @@ with st.container(border=True):
     figure2.plotly_chart(st.session_state['fig1'])
 
 
-# Run Live Feed
-while st.session_state['run']:
-    if not output('scope1', figure, success) and not output('scope2', figure2, success2):
-        break
+# Start/Stop Recording
+def recording_status():
+    lines = []
+    for scope_str, worker in workers.items():
+        recorder = worker.recorders.get(OWNER)
+        if recorder is None:
+            continue
+        lines.append(f'{SCOPES[scope_str][2].capitalize()}: {recorder.frames} frames ({recorder.dropped} dropped)')
+        if recorder.error is not None:
+            lines.append(f'Recording error: {recorder.error}')
+    if len(lines) > 0:
+        record_status.caption('  \n'.join(lines))
+    return
 
+saved = []
+for scope_str, worker in workers.items():
+    if st.session_state['record'] and OWNER not in worker.recorders:
+        name = st.session_state['record_name'] + '_' + scope_str + time.strftime('_%Y%m%d-%H%M%S.npy')
+        worker.recorders[OWNER] = stream_recorder(os.path.join(st.session_state['record_directory'], name))
+    elif not st.session_state['record'] and OWNER in worker.recorders:
+        recorder = worker.recorders.pop(OWNER)
+        recorder.close()
+        saved.append(f'Saved {recorder.frames} frames to {recorder.path}')
+if len(saved) > 0:
+    record_status.caption('  \n'.join(saved))
+recording_status()
 
-    
+
+# Performance: this script up to here and the last frames of the acquisition workers
+for worker in workers.values():
+    worker.profile = PROFILE
+instrumentation.panel('Live Feed', instrumentation.records() + [span for worker in workers.values() for span in worker.spans])
+
+# Run Live Feed
+FRAMES = {'scope1': (figure, success), 'scope2': (figure2, success2)}
+if st.session_state['run']:
+    for scope_str, (_, _, label) in SCOPES.items():
+        if scope_str not in workers:
+            st.error("Couldn't connect to the " + label + " scope")
+    for worker in workers.values():
+        worker.start(OWNER)
+
+    # Only render the latest frame of every scope; acquisition carries on in the background
+    shown = {scope_str: 0 for scope_str in workers}
+    errors = {scope_str: None for scope_str in workers}     # last error shown per scope
+    heartbeat = st.empty()
+    last_update = last_status = time.monotonic()
+    try:
+        while len(workers) > 0:
+            for scope_str, worker in workers.items():
+                error = worker.error
+                if error is not errors[scope_str]:
+                    # Only send a changed error to the browser
+                    errors[scope_str] = error
+                    if error is not None:
+                        FRAMES[scope_str][1].error(f'Acquisition stopped: {error}')
+                if error is not None:
+                    continue
+                with worker.ring.latest(after=shown[scope_str]) as latest:
+                    if latest is None:
+                        continue
+                    with instrumentation.span('output'):
+                        output(latest.time, latest.volts, *FRAMES[scope_str], st.session_state['R_stats'][scope_str])
+                    shown[scope_str] = latest.sequence
+                    last_update = time.monotonic()
+            if time.monotonic() - last_update > 1:
+                # No new records (e.g. scope stopped); scopes in error keep their message
+                for scope_str in workers:
+                    if errors[scope_str] is None:
+                        FRAMES[scope_str][1].info('Waiting for a new record')
+                # Every message to the browser keeps the script responsive to Run/Stop
+                heartbeat.empty()
+                last_update = time.monotonic()
+            if time.monotonic() - last_status > 1:
+                recording_status()
+                last_status = time.monotonic()
+            time.sleep(0.01)
+    finally:
+        # A rerun or a closed browser interrupts the loop: stop asking for frames
+        for worker in workers.values():
+            worker.pause(OWNER)
+else:
+    for worker in workers.values():
+        worker.pause(OWNER)